@@ -0,0 +1 @@
+from .instance_cache import instance_cache
\ No newline at end of file
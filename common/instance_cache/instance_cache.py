@@ -0,0 +1,132 @@
+import json, os, threading
+import redis
+
+from json_logger import logger
+from lazy_client import aws_client
+from metrics import metrics
+from rate_limiter import rate_limiter, HIGH
+from redis_pool import redis_client
+
+# The network identity of an instance never changes during its life, the TTL only bounds how long a
+# terminated instance that was never explicitly evicted stays in redis
+CACHE_TTL_SECONDS = int(os.getenv('INSTANCE_CACHE_TTL', '86400'))
+# DescribeInstances accepts up to 200 values per filter
+EC2_FILTER_CHUNK = 200
+NETWORK_FIELDS = ('PrivateDnsName', 'PrivateIpAddress', 'PublicDnsName', 'PublicIpAddress')
+TERMINATED_STATES = ('shutting-down', 'terminated')
+# A pending instance has no PrivateDnsName yet, only the identity of a running one is final
+CACHED_STATE = 'running'
+STATS_KEY = 'instance_cache.stats'
+# Cap on in-flight DescribeInstances calls when several game server groups are enriched concurrently
+EC2_CONCURRENCY = int(os.getenv('EC2_CONCURRENCY', '4'))
+
+class InstanceCache(object):
+    def __init__(self):
+        self.ec2 = aws_client('ec2')
+        self.ec2_limit = threading.BoundedSemaphore(EC2_CONCURRENCY)
+        # Without redis every lookup is a miss and goes straight to EC2
+        self.redis = metrics.instrument_redis(redis_client())
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, InstanceId: str):
+        return f'instance.{InstanceId}'
+
+    def _get(self, instance_ids):
+        if self.redis is None or len(instance_ids) == 0:
+            return {}
+        try:
+            values = self.redis.mget([self._key(InstanceId) for InstanceId in instance_ids])
+        except redis.RedisError as e:
+            logger.warning('Could not read instance cache', error=str(e))
+            return {}
+        return {InstanceId: json.loads(value) for InstanceId, value in zip(instance_ids, values) if value is not None}
+
+    def _put(self, identities):
+        if self.redis is None or len(identities) == 0:
+            return
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for InstanceId, identity in identities.items():
+                pipeline.set(self._key(InstanceId), json.dumps(identity), ex=CACHE_TTL_SECONDS)
+            pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning('Could not write instance cache', error=str(e))
+
+    def _count(self, hits: int, misses: int):
+        self.hits += hits
+        self.misses += misses
+        logger.debug('Instance cache lookup', hits=hits, misses=misses)
+        if self.redis is None:
+            return
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.hincrby(STATS_KEY, 'hits', hits)
+            pipeline.hincrby(STATS_KEY, 'misses', misses)
+            pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning('Could not update instance cache stats', error=str(e))
+
+    def evict(self, instance_ids):
+        """Drops the cached identity of instances that are being terminated."""
+        if self.redis is None or len(instance_ids) == 0:
+            return
+        try:
+            self.redis.delete(*[self._key(InstanceId) for InstanceId in instance_ids])
+        except redis.RedisError as e:
+            logger.warning('Could not evict instance cache', error=str(e))
+
+    def _describe_instances(self, instance_ids, priority: str):
+        """Resolves instances with bulk DescribeInstances calls under the shared rate limit. The instance ids are chunked
+        into instance-id filters rather than passed as InstanceIds, so an instance that has already disappeared is simply
+        missing from the result instead of failing the whole call."""
+        instances = {}
+        for i in range(0, len(instance_ids), EC2_FILTER_CHUNK):
+            kwargs = {'Filters': [{'Name': 'instance-id', 'Values': instance_ids[i:i + EC2_FILTER_CHUNK]}]}
+            while True:
+                with self.ec2_limit:
+                    page = rate_limiter.call(self.ec2.describe_instances, priority, **kwargs)
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        instances[instance['InstanceId']] = instance
+                if not page.get('NextToken'):
+                    break
+                kwargs['NextToken'] = page['NextToken']
+        return instances
+
+    def describe_instances(self, game_servers, priority: str = HIGH):
+        """Adds PrivateDnsName/PrivateIpAddress/PublicDnsName/PublicIpAddress to each game server. Known instances are
+        served from redis, only the unknown ones are resolved against EC2. Only running instances with a PrivateDnsName
+        are cached, a pending one is resolved again on the next lookup. Instances that are spot terminating or already
+        shutting down are evicted instead of cached. EC2 is called at the given rate limiter priority, the poller feeds
+        the drains and keeps HIGH."""
+        instance_ids = [game_server["InstanceId"] for game_server in game_servers]
+        identities = self._get(instance_ids)
+        missing = [InstanceId for InstanceId in instance_ids if InstanceId not in identities]
+        self._count(len(instance_ids) - len(missing), len(missing))
+
+        resolved = {}
+        terminated = []
+        if len(missing) > 0:
+            for InstanceId, instance in self._describe_instances(missing, priority).items():
+                identity = {field: instance.get(field) for field in NETWORK_FIELDS}
+                identities[InstanceId] = identity
+                state = instance.get('State', {}).get('Name')
+                if state in TERMINATED_STATES:
+                    terminated.append(InstanceId)
+                elif state == CACHED_STATE and identity.get('PrivateDnsName'):
+                    resolved[InstanceId] = identity
+
+        for game_server in game_servers:
+            if game_server.get("InstanceStatus") == 'SPOT_TERMINATING':
+                terminated.append(game_server["InstanceId"])
+                resolved.pop(game_server["InstanceId"], None)
+            identity = identities.get(game_server["InstanceId"])
+            if identity is not None:
+                game_server.update(identity)
+
+        self._put(resolved)
+        self.evict(terminated)
+        return game_servers
+
+instance_cache = InstanceCache()
@@ -0,0 +1 @@
+from .json_logger import logger
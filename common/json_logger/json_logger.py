@@ -0,0 +1,84 @@
+import collections, contextvars, functools, json, os, random, sys, threading, time
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Share of the sampled hot-loop messages that is kept, per call site it can be overridden with sample=
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1'))
+# Records kept in memory before they are written out ahead of the end of the invocation
+LOG_BUFFER_SIZE = int(os.getenv('LOG_BUFFER_SIZE', '1000'))
+
+class JsonLogger(object):
+    """Buffered structured logger. A record is only appended to an in-memory buffer when it is logged, serializing it
+    to a JSON line and writing it to stdout happens in flush(), at the end of the invocation or once LOG_BUFFER_SIZE
+    records are waiting. Every record carries the context fields bound where it was logged. They live in a context
+    variable, so a coroutine sees the fields of the caller that started it, and work handed to a thread pool keeps them
+    when it is submitted through contextvars.copy_context().run."""
+
+    def __init__(self):
+        self.level = LEVELS.get(LOG_LEVEL, LEVELS['INFO'])
+        self.sample_rate = LOG_SAMPLE_RATE
+        self.context = contextvars.ContextVar('json_logger_fields', default={})
+        self.buffer = collections.deque()
+        self.flush_lock = threading.Lock()
+
+    def set_level(self, level: str):
+        self.level = LEVELS[level.upper()]
+
+    def bind(self, **fields):
+        """Replaces the context fields of the current context, e.g. the message and instance a worker is handling."""
+        self.context.set(fields)
+
+    def fields(self):
+        return self.context.get()
+
+    def enabled(self, level: str):
+        return LEVELS[level] >= self.level
+
+    def log(self, level: str, message, sample: float = None, **fields):
+        """Buffers a record. sample keeps only that share of the calls, True uses LOG_SAMPLE_RATE."""
+        if LEVELS[level] < self.level:
+            return
+        if sample is not None:
+            if random.random() >= (self.sample_rate if sample is True else sample):
+                return
+            fields['sampled'] = True
+        self.buffer.append((time.time(), level, message, self.fields(), fields))
+        if LEVELS[level] >= LEVELS['ERROR'] or len(self.buffer) >= LOG_BUFFER_SIZE:
+            self.flush()
+
+    def debug(self, message, **fields):
+        self.log('DEBUG', message, **fields)
+
+    def info(self, message, **fields):
+        self.log('INFO', message, **fields)
+
+    def warning(self, message, **fields):
+        self.log('WARNING', message, **fields)
+
+    def error(self, message, **fields):
+        self.log('ERROR', message, **fields)
+
+    def flush(self):
+        with self.flush_lock:
+            lines = []
+            while len(self.buffer) > 0:
+                at, level, message, context, fields = self.buffer.popleft()
+                record = {'time': at, 'level': level, 'message': message}
+                record.update(context)
+                record.update(fields)
+                lines.append(json.dumps(record, default=str))
+            if len(lines) > 0:
+                sys.stdout.write('\n'.join(lines) + '\n')
+                sys.stdout.flush()
+
+    def flushing(self, handler):
+        """Decorates a lambda handler so the buffer is written out when it returns or raises."""
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                self.flush()
+        return wrapper
+
+logger = JsonLogger()
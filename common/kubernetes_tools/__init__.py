@@ -0,0 +1,2 @@
+from .kubernetes_tools import kubernetes_tools
+from .async_kubernetes_tools import async_kubernetes_tools
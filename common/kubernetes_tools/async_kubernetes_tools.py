@@ -0,0 +1,456 @@
+import asyncio, contextvars, json, os, threading, time
+
+from metrics import metrics
+from .kubernetes_tools import (kube_url, kube_token, gameserver_cache_staleness, gameserver_watch_timeout, node_patch_retries,
+    kube_patch_concurrency, drain_timeout, drain_concurrency, kubernetes_tools, print_messageId)
+
+# Connections the async client keeps open to the API server. Every in-flight call shares them on one event loop,
+# so this can be well above the thread counts of the blocking client.
+kube_async_pool_size = int(os.getenv('KUBE_ASYNC_POOL_SIZE', '100'))
+# Requests, except watches, that take longer than this many seconds fail
+kube_async_timeout = float(os.getenv('KUBE_ASYNC_TIMEOUT', '30'))
+
+STRATEGIC_MERGE_PATCH = 'application/strategic-merge-patch+json'
+
+async def in_context(context, coroutine):
+    # A task starts out with the context of the loop thread, take over what the caller had bound
+    for var, value in context.items():
+        var.set(value)
+    return await coroutine
+
+class GameServerCache(object):
+    """Informer-style local copy of the Agones GameServers, indexed by status.nodeName and status.state so that
+    "Allocated game servers on node X" is an in-memory lookup. It is filled with one list call and then kept current
+    by resuming a watch from the last seen resourceVersion. Lambda containers are frozen between invocations, so
+    rather than keeping a background watch open the cache catches up once it is older than the allowed staleness,
+    and falls back to a full list when the resourceVersion has expired. A max_staleness of 0 always lists, which is a
+    single round trip instead of waiting out the watch."""
+
+    def __init__(self, tools, max_staleness: float):
+        self.tools = tools
+        self.max_staleness = max_staleness
+        # Created on the event loop by the first refresh
+        self.lock = None
+        self.resource_version = None
+        self.refreshed_at = 0
+        self.items = {}
+        self.by_node = {}
+        self.by_state = {}
+
+    def _key(self, item):
+        return '{}/{}'.format(item['metadata']['namespace'], item['metadata']['name'])
+
+    def _remove(self, key: str):
+        item = self.items.pop(key, None)
+        if item is None:
+            return
+        status = item.get('status', {})
+        self.by_node.get(status.get('nodeName'), set()).discard(key)
+        self.by_state.get(status.get('state'), set()).discard(key)
+
+    def _add(self, item):
+        key = self._key(item)
+        self._remove(key)
+        self.items[key] = item
+        status = item.get('status', {})
+        self.by_node.setdefault(status.get('nodeName'), set()).add(key)
+        self.by_state.setdefault(status.get('state'), set()).add(key)
+
+    async def _list(self):
+        custom_objs = await self.tools.list_game_servers()
+        self.items, self.by_node, self.by_state = {}, {}, {}
+        for item in custom_objs['items']:
+            self._add(item)
+        self.resource_version = custom_objs['metadata']['resourceVersion']
+
+    async def _watch(self):
+        """Applies the events since resource_version. An expired resourceVersion raises ApiException 410."""
+        async for event in self.tools.watch_game_servers(self.resource_version):
+            item = event['object']
+            if event['type'] == 'DELETED':
+                self._remove(self._key(item))
+            elif event['type'] != 'BOOKMARK':
+                self._add(item)
+            self.resource_version = item['metadata']['resourceVersion']
+
+    async def refresh(self, max_staleness: float = None):
+        if max_staleness is None:
+            max_staleness = self.max_staleness
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if time.time() - self.refreshed_at < max_staleness:
+                return
+            try:
+                if max_staleness <= 0 or self.resource_version is None:
+                    await self._list()
+                else:
+                    await self._watch()
+            except kubernetes_tools.ApiException as e:
+                if e.status != 410:
+                    raise
+                print_messageId('GameServer watch expired, listing again', flush=True)
+                await self._list()
+            self.refreshed_at = time.time()
+
+    async def get(self, nodeName: str, state: str, max_staleness: float = None):
+        await self.refresh(max_staleness)
+        keys = self.by_node.get(nodeName, set()) & self.by_state.get(state, set())
+        return [self.items[key] for key in keys]
+
+class AsyncKubernetesTools(object):
+    """asyncio API for the operations the services run against the cluster, on top of one pooled aiohttp session
+    instead of a thread per call. KubernetesTools keeps the blocking client for the wrapper's node and pod reads.
+    Objects are the plain dicts the API server returns rather than client models. HTTP errors and transport failures,
+    a refused connection or a timeout, are raised as the same ApiException, the latter with status 0 like the blocking
+    client, so callers handle both APIs alike. aiohttp is only imported when the first request is made."""
+
+    def __init__(self):
+        self.session = None
+        self.loop = None
+        self.loop_lock = threading.Lock()
+        self.grace_period = 30
+        self.game_server_cache = GameServerCache(self, gameserver_cache_staleness)
+
+    def _loop(self):
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='kubernetes-async', daemon=True).start()
+            return self.loop
+
+    def run(self, coroutine):
+        """Runs a coroutine from blocking code and returns its result. Every coroutine runs on one event loop thread
+        kept for the life of the container, so the session and its connections are reused by warm invocations and the
+        calls of several worker threads are in flight together. The coroutine sees the log fields and metrics group of
+        the calling thread."""
+        return asyncio.run_coroutine_threadsafe(in_context(contextvars.copy_context(), coroutine), self._loop()).result()
+
+    async def _session(self):
+        # A session belongs to the loop it was created on
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.session_loop is not loop:
+            import aiohttp
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=kube_async_pool_size, ssl=False),
+                headers={'Authorization': 'Bearer ' + kube_token},
+                timeout=aiohttp.ClientTimeout(total=kube_async_timeout))
+            self.session_loop = loop
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    def _params(self, **params):
+        return {key: (str(value).lower() if isinstance(value, bool) else str(value)) for key, value in params.items() if value is not None}
+
+    def _error(self, status: int, reason: str, body: str):
+        error = kubernetes_tools.ApiException(status=status, reason=reason)
+        error.body = body
+        return error
+
+    async def _request(self, method: str, path: str, body=None, content_type: str = 'application/json', resource_path: str = None, **params):
+        """resource_path is the path template the call is recorded under, the same the blocking client reports."""
+        import aiohttp
+        session = await self._session()
+        headers = {'Content-Type': content_type} if body is not None else {}
+        with metrics.timer('kubernetes', f'{method} {resource_path or path}', is_throttle=lambda e: getattr(e, 'status', None) == 429):
+            try:
+                async with session.request(method, kube_url + path, params=self._params(**params), headers=headers,
+                        data=json.dumps(body) if body is not None else None) as resp:
+                    text = await resp.text()
+                    if resp.status >= 400:
+                        raise self._error(resp.status, resp.reason, text)
+                    return json.loads(text) if text else None
+            except asyncio.TimeoutError:
+                raise self._error(0, f'Timed out after {kube_async_timeout}s', '')
+            except aiohttp.ClientError as e:
+                raise self._error(0, f'{type(e).__name__}: {e}', '')
+
+    async def _watch(self, path: str, resource_version: str, timeout_seconds: int, **params):
+        """Yields the events of a watch resumed from resource_version until the server ends it after timeout_seconds.
+        An expired resourceVersion surfaces as ApiException 410 like with the blocking client."""
+        import aiohttp
+        session = await self._session()
+        try:
+            async with session.get(kube_url + path, timeout=aiohttp.ClientTimeout(total=timeout_seconds + kube_async_timeout),
+                    params=self._params(watch=True, resourceVersion=resource_version, timeoutSeconds=timeout_seconds, **params)) as resp:
+                if resp.status >= 400:
+                    raise self._error(resp.status, resp.reason, await resp.text())
+                async for line in resp.content:
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event['type'] == 'ERROR':
+                        status = event['object'].get('code', 500)
+                        raise self._error(status, event['object'].get('reason'), json.dumps(event['object']))
+                    yield event
+        except asyncio.TimeoutError:
+            raise self._error(0, f'Watch timed out after {timeout_seconds + kube_async_timeout}s', '')
+        except aiohttp.ClientError as e:
+            raise self._error(0, f'{type(e).__name__}: {e}', '')
+
+    async def list_game_servers(self, label_selector: str = None, limit: int = None, _continue: str = None):
+        return await self._request('GET', '/apis/agones.dev/v1/gameservers', labelSelector=label_selector, limit=limit, **{'continue': _continue})
+
+    def watch_game_servers(self, resource_version: str, timeout_seconds: int = gameserver_watch_timeout, label_selector: str = None):
+        return self._watch('/apis/agones.dev/v1/gameservers', resource_version, timeout_seconds, labelSelector=label_selector)
+
+    async def read_game_server(self, name: str, namespace: str):
+        return await self._request('GET', f'/apis/agones.dev/v1/namespaces/{namespace}/gameservers/{name}',
+            resource_path='/apis/agones.dev/v1/namespaces/{namespace}/gameservers/{name}')
+
+    async def node_game_servers(self, PrivateDnsName: str, state: str):
+        """Reads the game servers in the given state on the node from the API server rather than the cache: one list of
+        the node's game server pods and a read of each of their GameServers, instead of a list of the whole cluster."""
+        pods = await self.list_node_pods(PrivateDnsName, label_selector='agones.dev/gameserver')
+
+        async def read(pod):
+            try:
+                return await self.read_game_server(pod['metadata']['labels']['agones.dev/gameserver'], pod['metadata']['namespace'])
+            except kubernetes_tools.ApiException as e:
+                # The pod outlived its GameServer
+                if e.status != 404:
+                    raise
+            return None
+
+        items = await asyncio.gather(*[read(pod) for pod in pods['items']])
+        return [item for item in items if item is not None and item.get('status', {}).get('state') == state]
+
+    async def get_game_servers(self, PrivateDnsName: str, max_staleness: float = None):
+        """Returns the Allocated game servers on the node from the GameServer cache, up to max_staleness seconds old,
+        GAMESERVER_CACHE_STALENESS by default. No Allocated game servers is what lets the instance be deregistered, and
+        a session may have been allocated since the cache caught up, so that answer is confirmed with node_game_servers.
+        Returns None when the API server could not be asked."""
+        print_messageId('Scanning instance for game servers', level='DEBUG')
+        try:
+            filtered_list = await self.game_server_cache.get(PrivateDnsName, 'Allocated', max_staleness)
+            if len(filtered_list) == 0:
+                filtered_list = await self.node_game_servers(PrivateDnsName, 'Allocated')
+            return filtered_list
+        except kubernetes_tools.ApiException as e:
+            print_messageId(f'Exception when listing game servers: {e.reason}', level='WARNING')
+        return None
+
+    async def create_game_server_allocation(self, namespace: str, body):
+        return await self._request('POST', f'/apis/allocation.agones.dev/v1/namespaces/{namespace}/gameserverallocations', body,
+            resource_path='/apis/allocation.agones.dev/v1/namespaces/{namespace}/gameserverallocations')
+
+    async def read_node(self, PrivateDnsName: str):
+        return await self._request('GET', f'/api/v1/nodes/{PrivateDnsName}', resource_path='/api/v1/nodes/{name}')
+
+    async def patch_node(self, PrivateDnsName: str, body):
+        return await self._request('PATCH', f'/api/v1/nodes/{PrivateDnsName}', body, STRATEGIC_MERGE_PATCH, resource_path='/api/v1/nodes/{name}')
+
+    async def list_pods(self, label_selector: str = None, limit: int = None):
+        return await self._request('GET', '/api/v1/pods', labelSelector=label_selector, limit=limit)
+
+    async def list_node_pods(self, PrivateDnsName: str, label_selector: str = None):
+        return await self._request('GET', '/api/v1/pods', fieldSelector='spec.nodeName=' + PrivateDnsName, labelSelector=label_selector)
+
+    async def read_pod(self, name: str, namespace: str):
+        return await self._request('GET', f'/api/v1/namespaces/{namespace}/pods/{name}', resource_path='/api/v1/namespaces/{namespace}/pods/{name}')
+
+    async def patch_pod(self, name: str, namespace: str, body):
+        return await self._request('PATCH', f'/api/v1/namespaces/{namespace}/pods/{name}', body, STRATEGIC_MERGE_PATCH,
+            resource_path='/api/v1/namespaces/{namespace}/pods/{name}')
+
+    async def evict_pod(self, name: str, namespace: str, deadline: float):
+        """Evicts one pod, retrying with exponential backoff while a PodDisruptionBudget refuses it (429) until the
+        deadline. Returns evicted, gone, blocked or error."""
+        body = {
+            'apiVersion': 'policy/v1beta1',
+            'kind': 'Eviction',
+            'metadata': {
+                'name': name,
+                'namespace': namespace
+            }
+        }
+        if self.grace_period > 0:
+            body['deleteOptions'] = {'gracePeriodSeconds': self.grace_period}
+        backoff = 1
+        while True:
+            try:
+                await self._request('POST', f'/api/v1/namespaces/{namespace}/pods/{name}/eviction', body,
+                    resource_path='/api/v1/namespaces/{namespace}/pods/{name}/eviction')
+                return 'evicted'
+            except kubernetes_tools.ApiException as e:
+                if e.status == 404:
+                    return 'gone'
+                if e.status != 429:
+                    print_messageId(f'Exception when evicting {namespace}/{name}: {e.reason}', level='WARNING')
+                    return f'error: {e.reason}'
+            if time.time() + backoff > deadline:
+                return 'blocked'
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 8)
+
+    async def _ensure_node(self, InstanceId: str, PrivateDnsName: str, is_desired, patch_body):
+        """Reads the node and patches it only when is_desired(node) is False, so a node that already matches costs no write.
+        The patch carries the resourceVersion the node was read at: when another writer got in between, the API server
+        answers 409 Conflict and the read and patch are retried."""
+        for attempt in range(node_patch_retries):
+            try:
+                node = await self.read_node(PrivateDnsName)
+            except kubernetes_tools.ApiException as e:
+                print_messageId(f'Exception when reading node {PrivateDnsName}: {e.reason}', level='WARNING')
+                return False
+            if is_desired(node):
+                return True
+            body = patch_body(node)
+            body['metadata'] = {'resourceVersion': node['metadata']['resourceVersion']}
+            try:
+                await self.patch_node(PrivateDnsName, body)
+                return True
+            except kubernetes_tools.ApiException as e:
+                if e.status != 409:
+                    print_messageId(f'Exception when patching node {PrivateDnsName}: {e.reason}', level='WARNING')
+                    return False
+                print_messageId(f'Node {InstanceId} changed while patching, retrying', flush=True)
+        return False
+
+    async def taint_node(self, InstanceId: str, PrivateDnsName: str, TaintCont: str):
+        """Taints the node with the key, value and effect of TaintCont unless it already has the taint."""
+        taint = json.loads(TaintCont)
+
+        def is_tainted(node):
+            return any(existing.get('key') == taint['key'] and existing.get('value') == taint.get('value') and
+                existing.get('effect') == taint['effect'] for existing in node['spec'].get('taints') or [])
+
+        def taint_body(node):
+            print_messageId(f'Tainting node {InstanceId} with {taint["key"]}', flush=True)
+            return {'spec': {'taints': (node['spec'].get('taints') or []) + [taint]}}
+
+        return await self._ensure_node(InstanceId, PrivateDnsName, is_tainted, taint_body)
+
+    async def cordon_node(self, InstanceId: str, PrivateDnsName: str):
+        """Marks the node unschedulable unless it already is."""
+        def is_cordoned(node):
+            return node['spec'].get('unschedulable') == True
+
+        def cordon_body(node):
+            print_messageId(f'Cordoning node {InstanceId}', flush=True)
+            return {'spec': {'unschedulable': True}}
+
+        return await self._ensure_node(InstanceId, PrivateDnsName, is_cordoned, cordon_body)
+
+    async def _tolerate_pod(self, pod, toleration):
+        for attempt in range(2):
+            body = {
+                'metadata': {'resourceVersion': pod['metadata']['resourceVersion']},
+                'spec': {'tolerations': (pod['spec'].get('tolerations') or []) + [toleration]}
+            }
+            try:
+                await self.patch_pod(pod['metadata']['name'], pod['metadata']['namespace'], body)
+                return 'patched'
+            except kubernetes_tools.ApiException as e:
+                if e.status != 409:
+                    return f'error: {e.reason}'
+            # The pod changed since it was listed, patch the current version
+            try:
+                pod = await self.read_pod(pod['metadata']['name'], pod['metadata']['namespace'])
+            except kubernetes_tools.ApiException as e:
+                return f'error: {e.reason}'
+        return 'error: conflict'
+
+    async def tolerate_pods(self, PrivateDnsName: str, GameServers, Toleration: str):
+        """Adds the toleration to the pods of the given Agones game servers on the node. All of the node's game server pods
+        are fetched with a single list call, pods that already tolerate the taint are skipped and the rest are patched
+        kube_patch_concurrency at a time. Returns a result per namespace/name: patched, skipped, missing or error."""
+        toleration = json.loads(Toleration)
+        results = {'{}/{}'.format(item['metadata']['namespace'], item['metadata']['name']): 'missing' for item in GameServers}
+        if len(results) == 0:
+            return results
+        try:
+            pods = await self.list_node_pods(PrivateDnsName, label_selector='agones.dev/gameserver')
+        except kubernetes_tools.ApiException as e:
+            print_messageId(f'Exception when listing the pods of {PrivateDnsName}: {e.reason}', level='WARNING')
+            return {key: f'error: {e.reason}' for key in results}
+
+        semaphore = asyncio.Semaphore(kube_patch_concurrency)
+
+        async def tolerate(pod):
+            async with semaphore:
+                return await self._tolerate_pod(pod, toleration)
+
+        pending = {}
+        for pod in pods['items']:
+            key = '{}/{}'.format(pod['metadata']['namespace'], pod['metadata']['name'])
+            if key not in results:
+                continue
+            tolerated = any(existing.get('key') == toleration['key'] and existing.get('effect') == toleration['effect'] and
+                (existing.get('operator') == 'Exists' or existing.get('value') == toleration.get('value'))
+                for existing in pod['spec'].get('tolerations') or [])
+            if tolerated:
+                results[key] = 'skipped'
+            else:
+                pending[key] = tolerate(pod)
+        for key, result in zip(pending, await asyncio.gather(*pending.values())):
+            results[key] = result
+        print_messageId(f'Toleration results on {PrivateDnsName}: {results}', flush=True)
+        return results
+
+    async def _node_pods(self, PrivateDnsName: str):
+        pods = await self.list_node_pods(PrivateDnsName)
+        # Pods in kube-system stay, and so do DaemonSet pods because their controller would put them straight back
+        filtered_pods = [pod for pod in pods['items'] if pod['metadata']['namespace'] != 'kube-system' and
+            not any(owner.get('kind') == 'DaemonSet' for owner in pod['metadata'].get('ownerReferences') or [])]
+        return filtered_pods, pods['metadata']['resourceVersion']
+
+    async def drain_pods(self, InstanceId: str, PrivateDnsName: str, timeout: float = None):
+        """Evicts the node's pods that are not in kube-system, drain_concurrency at a time, while a watch on the node's
+        pods resumed from the list's resourceVersion tracks which of them have actually left. Returns once every pod is
+        gone or could not be evicted, or when the timeout expires, with the result per pod and the drain duration."""
+        started = time.time()
+        deadline = started + (drain_timeout if timeout is None else timeout)
+        try:
+            filtered_pods, resource_version = await self._node_pods(PrivateDnsName)
+        except kubernetes_tools.ApiException as e:
+            print_messageId(f'Exception when listing the pods of {PrivateDnsName}: {e.reason}', level='WARNING')
+            return {'node': PrivateDnsName, 'duration': time.time() - started, 'error': e.reason}
+
+        semaphore = asyncio.Semaphore(drain_concurrency)
+
+        async def evict(pod):
+            async with semaphore:
+                print_messageId(f'Evicting pod {pod["metadata"]["name"]} in namespace {pod["metadata"]["namespace"]}', flush=True)
+                return await self.evict_pod(pod['metadata']['name'], pod['metadata']['namespace'], deadline)
+
+        keys = ['{}/{}'.format(pod['metadata']['namespace'], pod['metadata']['name']) for pod in filtered_pods]
+        pending = set(keys)
+        tasks = dict(zip(keys, [asyncio.ensure_future(evict(pod)) for pod in filtered_pods]))
+
+        while len(pending) > 0 and time.time() < deadline:
+            # Pods whose eviction was refused for good are not going to leave, stop waiting for them
+            for key, task in tasks.items():
+                if task.done() and task.result() not in ('evicted', 'gone'):
+                    pending.discard(key)
+            try:
+                async for event in self._watch('/api/v1/pods', resource_version, max(1, min(5, int(deadline - time.time()))),
+                        fieldSelector='spec.nodeName=' + PrivateDnsName):
+                    pod = event['object']
+                    if event['type'] == 'DELETED':
+                        pending.discard('{}/{}'.format(pod['metadata']['namespace'], pod['metadata']['name']))
+                    resource_version = pod['metadata']['resourceVersion']
+                    if len(pending) == 0:
+                        break
+            except kubernetes_tools.ApiException as e:
+                print_messageId(f'Exception when watching the pods of {PrivateDnsName}: {e.reason}', level='WARNING')
+                if e.status != 410:
+                    await asyncio.sleep(1)
+                    continue
+                # The resourceVersion expired, start again from a fresh list
+                try:
+                    filtered_pods, resource_version = await self._node_pods(PrivateDnsName)
+                    pending &= {'{}/{}'.format(pod['metadata']['namespace'], pod['metadata']['name']) for pod in filtered_pods}
+                except kubernetes_tools.ApiException as e:
+                    print_messageId(f'Exception when listing the pods of {PrivateDnsName}: {e.reason}', level='WARNING')
+                    await asyncio.sleep(1)
+
+        results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+        duration = time.time() - started
+        print_messageId(f'Drained node {InstanceId}/{PrivateDnsName} in {duration:.1f}s, {len(pending)} pods left: {results}', flush=True)
+        return {'node': PrivateDnsName, 'duration': duration, 'pods': results, 'remaining': sorted(pending)}
+
+async_kubernetes_tools = AsyncKubernetesTools()
@@ -0,0 +1,138 @@
+import json, os, threading
+
+from json_logger import logger
+from metrics import metrics
+
+# The kubernetes package takes longer to import than the rest of a handler together, so it is only imported by
+# load_kubernetes() when the first client is built. Every ApiException comes out of a client, by then the name is bound.
+client = None
+ApiException = None
+kubernetes_lock = threading.Lock()
+
+def load_kubernetes():
+    global client, ApiException
+    with kubernetes_lock:
+        if client is None:
+            from kubernetes import client as kubernetes_client
+            from kubernetes.client.rest import ApiException as kubernetes_api_exception
+            ApiException = kubernetes_api_exception
+            client = kubernetes_client
+
+
+#SERVICE_ACCOUNT=cluster-autoscaler
+#SECRET=$(kubectl get serviceaccount -n kube-system ${SERVICE_ACCOUNT} -o json | jq -Mr '.secrets[].name | select(contains("token"))')  
+#TOKEN=$(kubectl get secret -n kube-system ${SECRET} -o json | jq -Mr '.data.token' | base64 -d)
+#kubectl get secret -n kube-system ${SECRET} -o json | jq -Mr '.data["ca.crt"]' | base64 -d > /tmp/ca.crt  
+#APISERVER=$(kubectl config view --minify | grep server | cut -f 2- -d ":" | tr -d " ")
+
+kube_url = os.getenv('kube_url')
+kube_token = os.getenv('kube_token')
+# Size of the urllib3 pool shared by the threads that call the Kubernetes API concurrently
+kube_pool_maxsize = int(os.getenv('KUBE_POOL_MAXSIZE', '16'))
+# GameServers are served from a local cache that catches up with the cluster once it is older than this many seconds
+gameserver_cache_staleness = float(os.getenv('GAMESERVER_CACHE_STALENESS', '5'))
+# How long a resumed watch stays open to collect the events missed since the last refresh. The API server only closes
+# the watch after this timeout, so every refresh of a stale cache takes at least this long
+gameserver_watch_timeout = int(os.getenv('GAMESERVER_WATCH_TIMEOUT', '1'))
+# Attempts for a node patch that keeps losing the optimistic concurrency race against other writers
+node_patch_retries = int(os.getenv('NODE_PATCH_RETRIES', '3'))
+# Pods patched at the same time when game servers are protected in bulk
+kube_patch_concurrency = int(os.getenv('KUBE_PATCH_CONCURRENCY', '10'))
+# A spot interruption leaves two minutes, evicting the pods and waiting for them to leave has to fit in there
+drain_timeout = float(os.getenv('DRAIN_TIMEOUT', '100'))
+# Evictions issued at the same time while draining a node
+drain_concurrency = int(os.getenv('DRAIN_CONCURRENCY', '10'))
+
+class KubernetesTools(object):
+    def __init__(self):
+        self.clients = None
+        self.clients_lock = threading.Lock()
+        self.grace_period = 30
+
+    def _connect(self):
+        """Builds the API clients on first use, once per container."""
+        if self.clients is None:
+            with self.clients_lock:
+                if self.clients is None:
+                    load_kubernetes()
+                    configuration = client.Configuration()
+                    configuration.host = kube_url
+                    configuration.verify_ssl = False
+                    configuration.api_key = {"authorization": "Bearer " + kube_token}
+                    configuration.connection_pool_maxsize = kube_pool_maxsize
+                    client1 = metrics.instrument_kubernetes(client.ApiClient(configuration=configuration))
+                    self.clients = {
+                        'core_v1_client': client.CoreV1Api(client1),
+                        'custom_obj_client': client.CustomObjectsApi(client1)
+                    }
+        return self.clients
+
+    @property
+    def core_v1_client(self):
+        return self._connect()['core_v1_client']
+
+    @property
+    def custom_obj_client(self):
+        return self._connect()['custom_obj_client']
+
+    @property
+    def ApiException(self):
+        """The kubernetes ApiException, for handlers that catch it without importing kubernetes themselves."""
+        load_kubernetes()
+        return ApiException
+
+    def set_messageId(self, messageId: str, instanceId: str):
+        # messageId/instanceId are bound per thread so concurrent workers each log their own instance
+        logger.bind(messageId=messageId, instanceId=instanceId)
+
+    def print_messageId(self, Content : str, flush : bool = True, level : str = 'INFO', **fields):
+        """Kept for the existing call sites, Content goes to the buffered JSON logger with the bound messageId/instanceId.
+        flush is ignored, the buffer is written out at the end of the handler."""
+        logger.log(level, Content, **fields)
+
+    def taint_pod(self, PodName: str, PodNamespace: str, Toleration: str):
+        toleration = json.loads(Toleration)
+        print_messageId(f"Updating {PodNamespace}/{PodName} with toleration", flush=True)
+        # Patch game server pod with toleration for DRAINING
+        try:
+            pods = self.core_v1_client.read_namespaced_pod(name=PodName, namespace=PodNamespace)
+        except ApiException as e:
+            print_messageId(f'Exception when calling CoreV1Api->read_namespaced_pod: {e}\n', level='WARNING')
+            return False
+        # if pods is None:
+        #     return
+        # tolerations check
+        tolerations = pods.spec.tolerations
+        if tolerations is None:
+            print_messageId(f'tolerations is none', flush=True)
+            tolerations = []
+        tolerations.append(toleration)
+        toleration_body = {
+            "spec": {
+                "tolerations": tolerations
+            }
+        }
+
+        try:
+            self.core_v1_client.patch_namespaced_pod(name=PodName, namespace=PodNamespace, body=toleration_body)
+        except ApiException as e:
+            print_messageId(f'Exception when calling CoreV1Api->patch_namespaced_pod: {e}\n', level='WARNING')
+        pass
+        return True
+
+    def patch_node(self, InstanceId: str, PrivateDnsName: str, Cordon: str):
+        try:
+            self.core_v1_client.patch_node(PrivateDnsName, json.loads(Cordon))
+            print_messageId(f'Node {InstanceId} has been cordoned', flush=True)
+        except ApiException as e:
+            print_messageId(f'Exception when calling CoreV1Api->patch_node: {e}\n', level='WARNING')
+        pass
+
+
+#print("Listing pods with their IPs:")
+#ret = kubernetes_tools.get_api().list_pod_for_all_namespaces(watch=False)
+#for i in ret.items:
+#    print("%s\t%s\t%s" % (i.status.pod_ip, i.metadata.namespace, i.metadata.name))
+
+kubernetes_tools = KubernetesTools()
+print_messageId = kubernetes_tools.print_messageId
\ No newline at end of file
@@ -0,0 +1 @@
+from .lazy_client import aws_client, aws_async_client, async_call
@@ -0,0 +1,66 @@
+import contextvars, functools, os, threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+# Creating clients from the default boto3 session is not thread safe, so they are built one at a time
+client_lock = threading.Lock()
+clients = {}
+# boto3 has no asyncio API, coroutines run its blocking calls on these threads
+AWS_ASYNC_CONCURRENCY = int(os.getenv('AWS_ASYNC_CONCURRENCY', '32'))
+aws_executor = None
+
+class LazyClient(object):
+    """Stands in for a boto3 client and builds it on first use. Importing a handler then costs neither boto3 nor the
+    service models of clients the invocation never calls, and the client is kept for the life of the container."""
+
+    def __init__(self, service_name: str):
+        self.service_name = service_name
+        self._client = None
+
+    def get(self):
+        if self._client is None:
+            with client_lock:
+                if self._client is None:
+                    import boto3
+                    self._client = metrics.instrument_boto3(boto3.client(self.service_name, region_name=os.getenv('AWS_REGION')))
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+def aws_client(service_name: str):
+    """Returns the memoized client of the service, shared by every module of the handler."""
+    with client_lock:
+        if service_name not in clients:
+            clients[service_name] = LazyClient(service_name)
+        return clients[service_name]
+
+class AsyncClient(object):
+    """Awaitable flavour of a LazyClient: every method returns an awaitable running the blocking call on aws_executor,
+    e.g. await aws_async_client('gamelift', HIGH).deregister_game_server(GameServerGroupName=group, GameServerId=id).
+    With a priority the calls go through rate_limiter.call in that lane, like the blocking call sites."""
+
+    def __init__(self, client: LazyClient, priority: str = None):
+        self.client = client
+        self.priority = priority
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if self.priority is None:
+            return functools.partial(async_call, method)
+        from rate_limiter import rate_limiter
+        return functools.partial(async_call, rate_limiter.call, method, self.priority)
+
+def aws_async_client(service_name: str, priority: str = None):
+    return AsyncClient(aws_client(service_name), priority)
+
+def async_call(method, *args, **kwargs):
+    """Runs any blocking call, a client method or e.g. rate_limiter.call, on aws_executor from a coroutine."""
+    global aws_executor
+    import asyncio
+    with client_lock:
+        if aws_executor is None:
+            aws_executor = ThreadPoolExecutor(max_workers=AWS_ASYNC_CONCURRENCY, thread_name_prefix='aws')
+    # The call keeps the logging and metrics context of the coroutine that awaits it
+    return asyncio.get_running_loop().run_in_executor(aws_executor, functools.partial(contextvars.copy_context().run, method, *args, **kwargs))
@@ -0,0 +1,266 @@
+import bisect, contextlib, contextvars, functools, json, os, sys, threading, time
+import redis
+
+from json_logger import logger
+from redis_pool import redis_client
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'FleetIQAgonesAdaptor')
+# Upper bounds of the latency histogram buckets in milliseconds, the last bucket is everything above
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# EMF accepts at most 100 values per metric and line
+EMF_MAX_VALUES = 100
+# Every container adds its aggregates to one hash per window, metrics.<window start>, read back by the wrapper's
+# get_metrics action. A window expires METRICS_RETENTION windows after it closed.
+METRICS_KEY = 'metrics'
+METRICS_WINDOW_SECONDS = int(os.getenv('METRICS_WINDOW_SECONDS', '3600'))
+METRICS_RETENTION = int(os.getenv('METRICS_RETENTION', '24'))
+THROTTLING_CODES = ('ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded')
+COUNTERS = ('calls', 'errors', 'throttles', 'latency_ms')
+
+def new_stat():
+    return {'calls': 0, 'errors': 0, 'throttles': 0, 'latency_ms': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1), 'values': []}
+
+class Metrics(object):
+    """Counts, error and throttle counts and latency histograms of every external call, per service, operation and
+    GameServerGroup. The calls are recorded by hooks on the boto3 clients, the Kubernetes ApiClient and the redis clients.
+    What an invocation recorded is written out as CloudWatch embedded metric format lines when the handler returns and
+    added to the hash of the current window in redis, so the aggregates of all containers can be read back."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.invocation = {}
+        self.totals = {}
+        self.context = contextvars.ContextVar('metrics_group', default=None)
+        # Without redis the aggregates only cover this container. emit() runs when every handler returns, the shared
+        # pool's timeouts keep a redis that stopped answering from holding up the response.
+        self.redis = redis_client()
+
+    def set_group(self, group: str):
+        """Tags the calls made in the current context from now on with the GameServerGroup. Work handed to a thread pool
+        keeps the tag when it is submitted through contextvars.copy_context().run."""
+        self.context.set(group)
+
+    def record(self, service: str, operation: str, latency_ms: float, error: bool = False, throttled: bool = False, group: str = None):
+        key = (service, operation, group or self.context.get() or 'none')
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)
+        with self.lock:
+            for stats in (self.invocation, self.totals):
+                stat = stats.get(key)
+                if stat is None:
+                    stat = stats[key] = new_stat()
+                stat['calls'] += 1
+                stat['errors'] += 1 if error else 0
+                stat['throttles'] += 1 if throttled else 0
+                stat['latency_ms'] += latency_ms
+                stat['buckets'][bucket] += 1
+            if len(self.invocation[key]['values']) < EMF_MAX_VALUES:
+                self.invocation[key]['values'].append(round(latency_ms, 3))
+
+    @contextlib.contextmanager
+    def timer(self, service: str, operation: str, group: str = None, is_throttle=None):
+        """Records the block as one call, failed when it raises. is_throttle(exception) tells throttling apart."""
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.record(service, operation, (time.perf_counter() - started) * 1000, error is not None,
+                error is not None and is_throttle is not None and is_throttle(error), group)
+
+    def instrument_boto3(self, client):
+        """Hooks the client's botocore events. The timer starts when the parameters are built, so it covers
+        serialization, signing, botocore's own retries and parsing."""
+        service = client.meta.service_model.service_name
+
+        def before_parameter_build(params, model, context, **kwargs):
+            context['metrics_started'] = time.perf_counter()
+            context['metrics_group'] = params.get('GameServerGroupName')
+
+        def after_call(http_response, parsed, model, context, **kwargs):
+            code = parsed.get('Error', {}).get('Code')
+            self.record(service, model.name, (time.perf_counter() - context.get('metrics_started', time.perf_counter())) * 1000,
+                code is not None or http_response.status_code >= 300, code in THROTTLING_CODES, context.get('metrics_group'))
+
+        def after_call_error(exception, model, context, **kwargs):
+            self.record(service, model.name, (time.perf_counter() - context.get('metrics_started', time.perf_counter())) * 1000,
+                True, False, context.get('metrics_group'))
+
+        client.meta.events.register('before-parameter-build', before_parameter_build)
+        client.meta.events.register('after-call', after_call)
+        client.meta.events.register('after-call-error', after_call_error)
+        return client
+
+    def instrument_kubernetes(self, api_client):
+        """Wraps ApiClient.call_api, the operation is the method and the path template, e.g. PATCH /api/v1/nodes/{name}."""
+        call_api = api_client.call_api
+
+        @functools.wraps(call_api)
+        def timed_call_api(resource_path, method, *args, **kwargs):
+            with self.timer('kubernetes', f'{method} {resource_path}', is_throttle=lambda e: getattr(e, 'status', None) == 429):
+                return call_api(resource_path, method, *args, **kwargs)
+
+        api_client.call_api = timed_call_api
+        return api_client
+
+    def instrument_redis(self, client):
+        """Times every command of the client by name, and a pipeline as one PIPELINE call."""
+        if client is None:
+            return client
+        execute_command = client.execute_command
+        pipeline = client.pipeline
+
+        def timed_execute_command(*args, **options):
+            with self.timer('redis', str(args[0]).split(' ')[0]):
+                return execute_command(*args, **options)
+
+        def timed_pipeline(*args, **kwargs):
+            instance = pipeline(*args, **kwargs)
+            execute = instance.execute
+
+            def timed_execute(*args, **kwargs):
+                with self.timer('redis', 'PIPELINE'):
+                    return execute(*args, **kwargs)
+
+            instance.execute = timed_execute
+            return instance
+
+        client.execute_command = timed_execute_command
+        client.pipeline = timed_pipeline
+        return client
+
+    def emit(self):
+        """Writes one EMF line per service, operation and GameServerGroup called during the invocation and adds them
+        to the aggregates in redis."""
+        with self.lock:
+            invocation, self.invocation = self.invocation, {}
+        if len(invocation) == 0:
+            return
+        timestamp = int(time.time() * 1000)
+        lines = []
+        for (service, operation, group), stat in invocation.items():
+            lines.append(json.dumps({
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [['Service', 'Operation', 'GameServerGroup']],
+                        'Metrics': [
+                            {'Name': 'Calls', 'Unit': 'Count'},
+                            {'Name': 'Errors', 'Unit': 'Count'},
+                            {'Name': 'Throttles', 'Unit': 'Count'},
+                            {'Name': 'Latency', 'Unit': 'Milliseconds'}
+                        ]
+                    }]
+                },
+                'Function': os.getenv('AWS_LAMBDA_FUNCTION_NAME'),
+                'Service': service,
+                'Operation': operation,
+                'GameServerGroup': group,
+                'Calls': stat['calls'],
+                'Errors': stat['errors'],
+                'Throttles': stat['throttles'],
+                'Latency': stat['values']
+            }))
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+        self._publish(invocation)
+
+    def _window_key(self, window: int):
+        return f'{METRICS_KEY}.{window * METRICS_WINDOW_SECONDS}'
+
+    def _publish(self, invocation):
+        if self.redis is None:
+            return
+        window = int(time.time() // METRICS_WINDOW_SECONDS)
+        window_key = self._window_key(window)
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for key, stat in invocation.items():
+                prefix = '|'.join(key)
+                for counter in ('calls', 'errors', 'throttles'):
+                    pipeline.hincrby(window_key, f'{prefix}|{counter}', stat[counter])
+                pipeline.hincrbyfloat(window_key, f'{prefix}|latency_ms', stat['latency_ms'])
+                for bucket, count in enumerate(stat['buckets']):
+                    if count > 0:
+                        pipeline.hincrby(window_key, f'{prefix}|bucket{bucket}', count)
+            pipeline.expire(window_key, (METRICS_RETENTION + 1) * METRICS_WINDOW_SECONDS)
+            pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning('Could not publish metrics', error=str(e))
+
+    def _load(self, windows: int):
+        """The aggregates of every container over the current and the windows - 1 previous windows from redis, or of
+        this container since it started without it."""
+        if self.redis is None:
+            with self.lock:
+                return {key: dict(stat, buckets=list(stat['buckets'])) for key, stat in self.totals.items()}
+        current = int(time.time() // METRICS_WINDOW_SECONDS)
+        pipeline = self.redis.pipeline(transaction=False)
+        for window in range(current - max(1, min(windows, METRICS_RETENTION)) + 1, current + 1):
+            pipeline.hgetall(self._window_key(window))
+        try:
+            windows = pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning('Could not read metrics', error=str(e))
+            windows = []
+        stats = {}
+        for fields in windows:
+            for field, value in fields.items():
+                service, operation, group, counter = field.decode().split('|')
+                stat = stats.get((service, operation, group))
+                if stat is None:
+                    stat = stats[(service, operation, group)] = new_stat()
+                if counter.startswith('bucket'):
+                    stat['buckets'][int(counter[len('bucket'):])] += int(value)
+                elif counter == 'latency_ms':
+                    stat['latency_ms'] += float(value)
+                else:
+                    stat[counter] += int(value)
+        return stats
+
+    def _percentile(self, buckets, p: float):
+        """Upper bound of the bucket the p-th percentile falls in, None when it is above the last bound."""
+        total = sum(buckets)
+        if total == 0:
+            return None
+        seen = 0
+        for bucket, count in enumerate(buckets):
+            seen += count
+            if seen >= p / 100 * total:
+                return LATENCY_BUCKETS_MS[bucket] if bucket < len(LATENCY_BUCKETS_MS) else None
+        return None
+
+    def aggregates(self, windows: int = 1):
+        results = []
+        for (service, operation, group), stat in sorted(self._load(windows).items()):
+            results.append({
+                'service': service,
+                'operation': operation,
+                'group': group,
+                'calls': stat['calls'],
+                'errors': stat['errors'],
+                'throttles': stat['throttles'],
+                'latency_ms': {
+                    'mean': stat['latency_ms'] / stat['calls'] if stat['calls'] > 0 else None,
+                    'p50': self._percentile(stat['buckets'], 50),
+                    'p95': self._percentile(stat['buckets'], 95),
+                    'p99': self._percentile(stat['buckets'], 99),
+                    'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS_MS] + ['inf'], stat['buckets']))
+                }
+            })
+        return results
+
+    def emitting(self, handler):
+        """Decorates a lambda handler so the metrics of the invocation are emitted when it returns or raises."""
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                self.emit()
+        return wrapper
+
+metrics = Metrics()
@@ -0,0 +1 @@
+from .rate_limiter import rate_limiter, RateLimited, HIGH, LOW
@@ -0,0 +1,150 @@
+import json, os, time
+import redis
+
+from json_logger import logger
+from metrics import metrics
+from redis_pool import redis_client
+
+# Token bucket per API shared through redis by the poller, the monitor invocations and the wrapper. Rates are in
+# calls per second and can be overridden per API with RATE_LIMITS, e.g. {"gamelift.update_game_server": 10}.
+# EC2 refills the bucket of its non-mutating Describe calls at 20 per second per account and region. GameLift publishes
+# no per-API rates for the FleetIQ game server calls, so theirs follow what the adaptor sends: every instance reports
+# its health with UpdateGameServer about once a minute, 20 per second covers some 1200 instances, while
+# registrations, claims and deregistrations only come with instances joining or leaving. DescribeGameServerInstances
+# throttles early, it stays at 2.
+DEFAULT_RATE = float(os.getenv('RATE_LIMIT_DEFAULT', '5'))
+SERVICE_RATES = {
+    'gamelift.describe_game_server_instances': 2,
+    'gamelift.update_game_server': 20,
+    'gamelift.register_game_server': 5,
+    'gamelift.claim_game_server': 5,
+    'gamelift.deregister_game_server': 5,
+    'ec2.describe_instances': 20,
+    'autoscaling.describe_auto_scaling_instances': 5,
+}
+RATE_LIMITS = dict(SERVICE_RATES, **json.loads(os.getenv('RATE_LIMITS', '{}')))
+# A full bucket allows a burst of RATE_LIMIT_BURST seconds worth of calls
+BURST_SECONDS = float(os.getenv('RATE_LIMIT_BURST', '2'))
+# Share of the bucket only high priority calls (heartbeats, drains) may take, dashboard reads stop short of it
+RESERVE_RATIO = float(os.getenv('RATE_LIMIT_RESERVE', '0.5'))
+# Longest a call waits for a token. A low priority call then fails with RateLimited, a high priority one, a heartbeat
+# or a drain, goes ahead and leaves it to the service's own throttling. Either way the wait is recorded as a
+# rate_limiter call in the metrics, failed when no token came.
+MAX_WAIT_SECONDS = float(os.getenv('RATE_LIMIT_MAX_WAIT', '10'))
+# A ThrottlingException halves the refill rate of the API, which then recovers by RATE_LIMIT_RECOVERY per second
+RECOVERY_PER_SECOND = float(os.getenv('RATE_LIMIT_RECOVERY', '0.05'))
+MIN_FACTOR = 0.1
+THROTTLE_RETRIES = int(os.getenv('RATE_LIMIT_THROTTLE_RETRIES', '3'))
+THROTTLING_CODES = ('ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded')
+BUCKET_TTL_SECONDS = 3600
+
+HIGH = 'high'
+LOW = 'low'
+
+# KEYS[1] bucket hash, ARGV[1] mode (take|throttled), ARGV[2] rate, ARGV[3] capacity, ARGV[4] reserve,
+# ARGV[5] now, ARGV[6] recovery per second, ARGV[7] minimum factor, ARGV[8] ttl.
+# Returns the seconds to wait before retrying, 0 when a token was taken. Returned as a string since redis
+# truncates Lua numbers to integers.
+BUCKET_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'factor')
+local rate = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local now = tonumber(ARGV[5])
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+local factor = tonumber(bucket[3]) or 1
+local elapsed = math.max(0, now - ts)
+factor = math.min(1, factor + elapsed * tonumber(ARGV[6]))
+tokens = math.min(capacity, tokens + elapsed * rate * factor)
+local wait = 0
+if ARGV[1] == 'throttled' then
+    factor = math.max(tonumber(ARGV[7]), factor / 2)
+    tokens = 0
+elseif tokens >= 1 + reserve then
+    tokens = tokens - 1
+else
+    wait = (1 + reserve - tokens) / (rate * factor)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now, 'factor', factor)
+redis.call('EXPIRE', KEYS[1], ARGV[8])
+return tostring(wait)
+"""
+
+class RateLimited(Exception):
+    """Raised for a low priority call that got no token within MAX_WAIT_SECONDS."""
+
+    def __init__(self, api: str):
+        super().__init__(f'Rate limit of {api} exhausted')
+        self.api = api
+
+class RateLimiter(object):
+    def __init__(self):
+        # Without redis calls are not coordinated and only botocore's own retries apply. The shared pool times out,
+        # so a redis that stops answering fails open instead of holding up every AWS call.
+        self.redis = metrics.instrument_redis(redis_client())
+        self.bucket = self.redis.register_script(BUCKET_SCRIPT) if self.redis is not None else None
+
+    def _key(self, api: str):
+        return f'rate_limit.{api}'
+
+    def _update(self, api: str, mode: str, priority: str):
+        """Runs the bucket script, returns the seconds to wait. Fails open when redis is unavailable."""
+        if self.bucket is None:
+            return 0
+        rate = float(RATE_LIMITS.get(api, DEFAULT_RATE))
+        capacity = max(1.0, rate * BURST_SECONDS)
+        reserve = capacity * RESERVE_RATIO if priority == LOW else 0
+        try:
+            return float(self.bucket(keys=[self._key(api)], args=[mode, rate, capacity, reserve, time.time(),
+                RECOVERY_PER_SECOND, MIN_FACTOR, BUCKET_TTL_SECONDS]))
+        except redis.RedisError as e:
+            logger.warning('Could not update rate limit', api=api, error=str(e))
+            return 0
+
+    def acquire(self, api: str, priority: str = LOW):
+        """Waits for a token of the API, at most MAX_WAIT_SECONDS. Returns False when none came."""
+        started = time.time()
+        deadline = started + MAX_WAIT_SECONDS
+        waited = False
+        while True:
+            wait = self._update(api, 'take', priority)
+            if wait <= 0:
+                acquired = True
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                acquired = False
+                break
+            time.sleep(min(wait, remaining))
+            waited = True
+        if waited:
+            metrics.record('rate_limiter', api, (time.time() - started) * 1000, not acquired, True)
+        return acquired
+
+    def throttled(self, api: str):
+        """Backs the API off for every caller after the service throttled it."""
+        logger.warning('Throttled, backing off', api=api)
+        self._update(api, 'throttled', HIGH)
+
+    def call(self, method, priority: str = LOW, **kwargs):
+        """Calls a boto3 client method under the rate limit of its operation, e.g.
+        rate_limiter.call(gamelift.update_game_server, HIGH, GameServerGroupName=...). Throttled calls are retried up to
+        THROTTLE_RETRIES times, any other error is raised as is. A LOW priority call raises RateLimited when it got no
+        token within MAX_WAIT_SECONDS."""
+        # botocore is loaded by the time a client method exists
+        from botocore.exceptions import ClientError
+        api = f'{method.__self__.meta.service_model.service_name}.{method.__name__}'
+        for attempt in range(THROTTLE_RETRIES + 1):
+            if not self.acquire(api, priority):
+                if priority == LOW:
+                    raise RateLimited(api)
+                logger.warning('Rate limit still exhausted, calling anyway at high priority', api=api, waited=MAX_WAIT_SECONDS)
+            try:
+                return method(**kwargs)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in THROTTLING_CODES or attempt == THROTTLE_RETRIES:
+                    raise
+                self.throttled(api)
+
+rate_limiter = RateLimiter()
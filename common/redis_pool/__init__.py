@@ -0,0 +1 @@
+from .redis_pool import redis_client
@@ -0,0 +1,33 @@
+import os, threading
+import redis
+
+# One bounded, thread-safe connection pool per container, shared by the handler, the rate limiter, the instance cache
+# and the metrics. Every socket operation times out after REDIS_SOCKET_TIMEOUT, so a redis that blackholes traffic
+# surfaces as a RedisError the callers fail open on, instead of hanging them. Connections are health checked when they
+# have been idle for REDIS_HEALTH_CHECK_INTERVAL instead of pinging before every command, and a caller waits up to
+# REDIS_POOL_TIMEOUT for a free connection.
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '16'))
+REDIS_POOL_TIMEOUT = int(os.getenv('REDIS_POOL_TIMEOUT', '5'))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '2'))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+
+pool = None
+pool_lock = threading.Lock()
+
+def redis_client(default_url: str = None):
+    """Returns a client on the container's shared pool for REDIS_URL, or default_url when it is not set. Returns None
+    when neither is set, callers then run without redis."""
+    global pool
+    redis_url = os.getenv('REDIS_URL', default_url)
+    if not redis_url:
+        return None
+    with pool_lock:
+        if pool is None:
+            pool = redis.BlockingConnectionPool.from_url(
+                'redis://' + redis_url,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                timeout=REDIS_POOL_TIMEOUT,
+                socket_timeout=REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+                health_check_interval=REDIS_HEALTH_CHECK_INTERVAL)
+    return redis.Redis(connection_pool=pool)
@@ -1,7 +1,11 @@
+import threading
 import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from cached_property import cached_property
+from json_logger import logger
+from requests.adapters import HTTPAdapter
 
 __all__ = ("ec2_metadata",)
 
@@ -17,28 +21,99 @@ USERDATA_URL = SERVICE_URL + "user-data/"
 TOKEN_TTL_SECONDS = 21600
 TOKEN_HEADER = "X-aws-ec2-metadata-token"
 TOKEN_HEADER_TTL = "X-aws-ec2-metadata-token-ttl-seconds"
+# Paths fetched at once by snapshot(), also the size of the keep-alive pool
+SNAPSHOT_CONCURRENCY = 10
+
+
+class ttl_property:
+    """Like cached_property, but the cached value expires after ttl seconds. None keeps it forever and 0 never
+    caches. The TTL of an attribute can be overridden per object with the ttls argument of its constructor."""
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+
+    def __call__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+        return self
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        ttl = obj.__dict__.get("_ttls", {}).get(self.name, self.ttl)
+        cache = obj.__dict__.setdefault("_ttl_cache", {})
+        now = time.monotonic()
+        cached = cache.get(self.name)
+        if cached is not None and (ttl is None or now - cached[1] < ttl):
+            return cached[0]
+        value = self.func(obj)
+        if ttl != 0:
+            cache[self.name] = (value, now)
+        return value
 
 
 class BaseLazyObject:
+    snapshot_attributes = ()
+
+    def clear(self, *names):
+        """Forgets the cached value of the given attributes."""
+        cache = self.__dict__.get("_ttl_cache", {})
+        for name in names:
+            cache.pop(name, None)
+
     def clear_all(self):
-        for key in tuple(self.__dict__.keys()):
-            if isinstance(getattr(self.__class__, key, None), cached_property):
-                del self.__dict__[key]
+        self.__dict__.get("_ttl_cache", {}).clear()
+
+    def snapshot(self, attributes=None):
+        """Reads the attributes concurrently and returns them as an immutable namedtuple, snapshot_attributes when
+        none are given. Values still within their TTL are not fetched again."""
+        attributes = tuple(attributes or self.snapshot_attributes)
+        # Get the token once up front instead of racing for it in every worker
+        self._ensure_token_is_fresh()
+        with ThreadPoolExecutor(max_workers=max(1, min(SNAPSHOT_CONCURRENCY, len(attributes)))) as executor:
+            values = list(executor.map(lambda name: getattr(self, name), attributes))
+        return namedtuple(type(self).__name__ + "Snapshot", attributes)(*values)
 
 
 class EC2Metadata(BaseLazyObject):
-    def __init__(self, session=None):
+    snapshot_attributes = (
+        "instance_id",
+        "instance_type",
+        "availability_zone",
+        "region",
+        "private_hostname",
+        "private_ipv4",
+        "public_hostname",
+        "public_ipv4",
+        "mac",
+        "spot_instance_action",
+    )
+
+    def __init__(self, session=None, service_url=SERVICE_URL, ttls=None):
         if session is None:
+            # Keep-alive connections for every concurrent snapshot() worker
             session = requests.Session()
+            session.mount("http://", HTTPAdapter(pool_maxsize=SNAPSHOT_CONCURRENCY))
         self._session = session
         self._token_updated_at = 0
+        self._token_lock = threading.Lock()
+        self._ttls = dict(ttls or {})
+        self._service_url = service_url
+        self._dynamic_url = service_url + "dynamic/"
+        self._metadata_url = service_url + "meta-data/"
+        self._userdata_url = service_url + "user-data/"
 
     def _ensure_token_is_fresh(self):
+        with self._token_lock:
+            self._refresh_token()
+
+    def _refresh_token(self):
         now = time.time()
         # Refresh up to 60 seconds before expiry
         if now - self._token_updated_at > (TOKEN_TTL_SECONDS - 60):
             token_response = self._session.put(
-                SERVICE_URL + "api/token",
+                self._service_url + "api/token",
                 headers={TOKEN_HEADER_TTL: str(TOKEN_TTL_SECONDS)},
                 timeout=5.0,
             )
@@ -55,49 +130,53 @@ class EC2Metadata(BaseLazyObject):
             resp.raise_for_status()
         return resp
 
-    def clear_all(self):
-        super().clear_all()
+    def reset_token(self):
+        """Drops the IMDSv2 token, the next request asks for a new one. For a token that expired or was revoked early."""
         self._session.headers.pop(TOKEN_HEADER, None)
         self._token_updated_at = 0
 
+    def clear_all(self):
+        super().clear_all()
+        self.reset_token()
+
     @property
     def account_id(self):
         return self.instance_identity_document["accountId"]
 
-    @cached_property
+    @ttl_property()
     def ami_id(self):
-        return self._get_url(METADATA_URL + "ami-id").text
+        return self._get_url(self._metadata_url + "ami-id").text
 
-    @cached_property
+    @ttl_property()
     def availability_zone(self):
-        return self._get_url(METADATA_URL + "placement/availability-zone").text
+        return self._get_url(self._metadata_url + "placement/availability-zone").text
 
-    @cached_property
+    @ttl_property()
     def ami_launch_index(self):
-        return int(self._get_url(METADATA_URL + "ami-launch-index").text)
+        return int(self._get_url(self._metadata_url + "ami-launch-index").text)
 
-    @cached_property
+    @ttl_property()
     def ami_manifest_path(self):
-        return self._get_url(METADATA_URL + "ami-manifest-path").text
+        return self._get_url(self._metadata_url + "ami-manifest-path").text
 
-    @cached_property
+    @ttl_property()
     def iam_info(self):
-        resp = self._get_url(METADATA_URL + "iam/info", allow_404=True)
+        resp = self._get_url(self._metadata_url + "iam/info", allow_404=True)
         if resp.status_code == 404:
             return None
         return resp.json()
 
-    @property
+    @ttl_property(0)
     def instance_action(self):
-        return self._get_url(METADATA_URL + "instance-action").text
+        return self._get_url(self._metadata_url + "instance-action").text
 
-    @cached_property
+    @ttl_property()
     def instance_id(self):
-        return self._get_url(METADATA_URL + "instance-id").text
+        return self._get_url(self._metadata_url + "instance-id").text
 
-    @cached_property
+    @ttl_property()
     def instance_identity_document(self):
-        return self._get_url(DYNAMIC_URL + "instance-identity/document").json()
+        return self._get_url(self._dynamic_url + "instance-identity/document").json()
 
     @property
     def instance_profile_arn(self):
@@ -113,86 +192,101 @@ class EC2Metadata(BaseLazyObject):
             return None
         return iam_info["InstanceProfileId"]
 
-    @cached_property
+    @ttl_property()
     def instance_type(self):
-        return self._get_url(METADATA_URL + "instance-type").text
+        return self._get_url(self._metadata_url + "instance-type").text
 
-    @cached_property
+    @ttl_property()
     def kernel_id(self):
-        resp = self._get_url(METADATA_URL + "kernel-id", allow_404=True)
+        resp = self._get_url(self._metadata_url + "kernel-id", allow_404=True)
         if resp.status_code == 404:
             return None
         return resp.text
 
-    @cached_property
+    @ttl_property()
     def mac(self):
-        return self._get_url(METADATA_URL + "mac").text
+        return self._get_url(self._metadata_url + "mac").text
 
-    @cached_property
+    @ttl_property()
     def network_interfaces(self):
-        macs_text = self._get_url(METADATA_URL + "network/interfaces/macs/").text
+        macs_text = self._get_url(self._metadata_url + "network/interfaces/macs/").text
         macs = [line.rstrip("/") for line in macs_text.splitlines()]
         return {mac: NetworkInterface(mac, self) for mac in macs}
 
-    @cached_property
+    @ttl_property()
     def private_hostname(self):
-        return self._get_url(METADATA_URL + "local-hostname").text
+        return self._get_url(self._metadata_url + "local-hostname").text
 
-    @cached_property
+    @ttl_property()
     def private_ipv4(self):
-        return self._get_url(METADATA_URL + "local-ipv4").text
+        return self._get_url(self._metadata_url + "local-ipv4").text
 
-    @cached_property
+    @ttl_property()
     def public_hostname(self):
-        resp = self._get_url(METADATA_URL + "public-hostname", allow_404=True)
+        resp = self._get_url(self._metadata_url + "public-hostname", allow_404=True)
         if resp.status_code == 404:
             return None
         return resp.text
 
-    @cached_property
+    @ttl_property()
     def public_ipv4(self):
-        resp = self._get_url(METADATA_URL + "public-ipv4", allow_404=True)
+        resp = self._get_url(self._metadata_url + "public-ipv4", allow_404=True)
         if resp.status_code == 404:
             return None
         return resp.text
 
-    @property
+    @ttl_property(0)
     def spot_instance_action(self):
-        resp = self._get_url(METADATA_URL + "spot/instance-action", allow_404=True)
+        """The pending spot interruption as {"action": ..., "time": ...}, None while there is none."""
+        resp = self._get_url(self._metadata_url + "spot/instance-action", allow_404=True)
         if resp.status_code == 404:
             return None
-        elif resp != None and (resp.status_code < 200 or resp >= 300):
-            print(f'Metadata request received http status code {resp.StatusCode}')
-            return resp.status_code
-            
+        elif resp.status_code < 200 or resp.status_code >= 300:
+            logger.warning("Unexpected metadata response", path="spot/instance-action", status=resp.status_code)
+            return None
+        return resp.json()
 
-    @cached_property
+    @ttl_property()
     def region(self):
         return self.instance_identity_document["region"]
 
-    @cached_property
+    @ttl_property()
     def reservation_id(self):
-        return self._get_url(METADATA_URL + "reservation-id").text
+        return self._get_url(self._metadata_url + "reservation-id").text
 
-    @cached_property
+    @ttl_property()
     def security_groups(self):
-        return self._get_url(METADATA_URL + "security-groups").text.splitlines()
+        return self._get_url(self._metadata_url + "security-groups").text.splitlines()
 
-    @cached_property
+    @ttl_property()
     def user_data(self):
-        resp = self._get_url(USERDATA_URL, allow_404=True)
+        resp = self._get_url(self._userdata_url, allow_404=True)
         if resp.status_code == 404:
             return None
         return resp.content
 
 
 class NetworkInterface(BaseLazyObject):
-    def __init__(self, mac, parent=None):
+    snapshot_attributes = (
+        "interface_id",
+        "device_number",
+        "private_ipv4s",
+        "public_ipv4s",
+        "security_group_ids",
+        "subnet_id",
+        "vpc_id",
+    )
+
+    def __init__(self, mac, parent=None, ttls=None):
         self.mac = mac
         if parent is None:
             self.parent = ec2_metadata
         else:
             self.parent = parent
+        self._ttls = dict(ttls or {})
+
+    def _ensure_token_is_fresh(self):
+        self.parent._ensure_token_is_fresh()
 
     def __repr__(self):
         return "NetworkInterface({mac})".format(mac=repr(self.mac))
@@ -206,18 +300,18 @@ class NetworkInterface(BaseLazyObject):
 
     def _url(self, item):
         return "{base}network/interfaces/macs/{mac}/{item}".format(
-            base=METADATA_URL, mac=self.mac, item=item
+            base=self.parent._metadata_url, mac=self.mac, item=item
         )
 
-    @cached_property
+    @ttl_property()
     def device_number(self):
         return int(self.parent._get_url(self._url("device-number")).text)
 
-    @cached_property
+    @ttl_property()
     def interface_id(self):
         return self.parent._get_url(self._url("interface-id")).text
 
-    @cached_property
+    @ttl_property()
     def ipv4_associations(self):
         associations = {}
         for public_ip in self.public_ipv4s:
@@ -227,59 +321,59 @@ class NetworkInterface(BaseLazyObject):
             associations[public_ip] = private_ips
         return associations
 
-    @cached_property
+    @ttl_property()
     def ipv6s(self):
         resp = self.parent._get_url(self._url("ipv6s"), allow_404=True)
         if resp.status_code == 404:
             return []
         return resp.text.splitlines()
 
-    @cached_property
+    @ttl_property()
     def owner_id(self):
         return self.parent._get_url(self._url("owner-id")).text
 
-    @cached_property
+    @ttl_property()
     def private_hostname(self):
         return self.parent._get_url(self._url("local-hostname")).text
 
-    @cached_property
+    @ttl_property()
     def private_ipv4s(self):
         return self.parent._get_url(self._url("local-ipv4s")).text.splitlines()
 
-    @cached_property
+    @ttl_property()
     def public_hostname(self):
         resp = self.parent._get_url(self._url("public-hostname"), allow_404=True)
         if resp.status_code == 404:
             return None
         return resp.text
 
-    @cached_property
+    @ttl_property()
     def public_ipv4s(self):
         resp = self.parent._get_url(self._url("public-ipv4s"), allow_404=True)
         if resp.status_code == 404:
             return []
         return resp.text.splitlines()
 
-    @cached_property
+    @ttl_property()
     def security_groups(self):
         return self.parent._get_url(self._url("security-groups")).text.splitlines()
 
-    @cached_property
+    @ttl_property()
     def security_group_ids(self):
         return self.parent._get_url(self._url("security-group-ids")).text.splitlines()
 
-    @cached_property
+    @ttl_property()
     def subnet_id(self):
         return self.parent._get_url(self._url("subnet-id")).text
 
-    @cached_property
+    @ttl_property()
     def subnet_ipv4_cidr_block(self):
         resp = self.parent._get_url(self._url("subnet-ipv4-cidr-block"), allow_404=True)
         if resp.status_code == 404:
             return None
         return resp.text
 
-    @cached_property
+    @ttl_property()
     def subnet_ipv6_cidr_blocks(self):
         resp = self.parent._get_url(
             self._url("subnet-ipv6-cidr-blocks"), allow_404=True
@@ -288,25 +382,25 @@ class NetworkInterface(BaseLazyObject):
             return []
         return resp.text.splitlines()
 
-    @cached_property
+    @ttl_property()
     def vpc_id(self):
         return self.parent._get_url(self._url("vpc-id")).text
 
-    @cached_property
+    @ttl_property()
     def vpc_ipv4_cidr_block(self):
         resp = self.parent._get_url(self._url("vpc-ipv4-cidr-block"), allow_404=True)
         if resp.status_code == 404:
             return None
         return resp.text
 
-    @cached_property
+    @ttl_property()
     def vpc_ipv4_cidr_blocks(self):
         resp = self.parent._get_url(self._url("vpc-ipv4-cidr-blocks"), allow_404=True)
         if resp.status_code == 404:
             return []
         return resp.text.splitlines()
 
-    @cached_property
+    @ttl_property()
     def vpc_ipv6_cidr_blocks(self):
         resp = self.parent._get_url(self._url("vpc-ipv6-cidr-blocks"), allow_404=True)
         if resp.status_code == 404:
@@ -0,0 +1,123 @@
+"""A local stand-in for the instance metadata service, to run ec2_metadata and the spot watcher off EC2.
+
+    server = FakeIMDS().start()
+    metadata = EC2Metadata(service_url=server.url)
+    server.paths["meta-data/spot/instance-action"] = json.dumps({"action": "terminate", "time": "..."})
+    server.stop()
+
+or standalone with `python -m ec2_metadata.fake_imds --port 8111`. It speaks IMDSv2 only: a token has to be
+requested with PUT api/token and sent with every GET, like on an instance that enforces it.
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .ec2_metadata import TOKEN_HEADER, TOKEN_HEADER_TTL
+
+MAC = "0e:00:00:00:00:01"
+DEFAULT_PATHS = {
+    "meta-data/ami-id": "ami-0123456789abcdef0",
+    "meta-data/ami-launch-index": "0",
+    "meta-data/instance-id": "i-0123456789abcdef0",
+    "meta-data/instance-type": "c5.large",
+    "meta-data/local-hostname": "ip-10-0-0-10.ec2.internal",
+    "meta-data/local-ipv4": "10.0.0.10",
+    "meta-data/public-hostname": "ec2-3-0-0-10.compute-1.amazonaws.com",
+    "meta-data/public-ipv4": "3.0.0.10",
+    "meta-data/mac": MAC,
+    "meta-data/placement/availability-zone": "us-east-1a",
+    "meta-data/security-groups": "eksctl-nodegroup",
+    "meta-data/network/interfaces/macs/": MAC + "/",
+    "meta-data/network/interfaces/macs/" + MAC + "/device-number": "0",
+    "meta-data/network/interfaces/macs/" + MAC + "/interface-id": "eni-0123456789abcdef0",
+    "meta-data/network/interfaces/macs/" + MAC + "/local-ipv4s": "10.0.0.10",
+    "meta-data/network/interfaces/macs/" + MAC + "/public-ipv4s": "3.0.0.10",
+    "meta-data/network/interfaces/macs/" + MAC + "/security-group-ids": "sg-0123456789abcdef0",
+    "meta-data/network/interfaces/macs/" + MAC + "/subnet-id": "subnet-0123456789abcdef0",
+    "meta-data/network/interfaces/macs/" + MAC + "/vpc-id": "vpc-0123456789abcdef0",
+    "dynamic/instance-identity/document": json.dumps(
+        {
+            "accountId": "123456789012",
+            "instanceId": "i-0123456789abcdef0",
+            "region": "us-east-1",
+            "availabilityZone": "us-east-1a",
+        }
+    ),
+}
+
+
+class FakeIMDS:
+    def __init__(self, paths=None, host="127.0.0.1", port=0, delay=0):
+        """paths maps a path below latest/ to the text served for it, missing paths answer 404. delay is added to
+        every GET to mimic the round trip of the real service."""
+        self.paths = dict(DEFAULT_PATHS if paths is None else paths)
+        self.delay = delay
+        self.tokens = set()
+        self.requests = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/latest/"
+
+    def _handler(self):
+        imds = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real service
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status, body=""):
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_PUT(self):
+                if self.path != "/latest/api/token" or self.headers.get(TOKEN_HEADER_TTL) is None:
+                    return self._reply(400)
+                token = uuid.uuid4().hex
+                imds.tokens.add(token)
+                self._reply(200, token)
+
+            def do_GET(self):
+                imds.requests += 1
+                if imds.delay:
+                    time.sleep(imds.delay)
+                if self.headers.get(TOKEN_HEADER) not in imds.tokens:
+                    return self._reply(401)
+                body = imds.paths.get(self.path[len("/latest/"):]) if self.path.startswith("/latest/") else None
+                if body is None:
+                    return self._reply(404)
+                self._reply(200, body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake instance metadata service.")
+    parser.add_argument("--port", type=int, default=8111)
+    parser.add_argument("--delay", type=float, default=0)
+    args = parser.parse_args()
+    server = FakeIMDS(port=args.port, delay=args.delay)
+    print(f"Serving fake IMDS on {server.url}", flush=True)
+    server._server.serve_forever()
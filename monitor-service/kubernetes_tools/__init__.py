@@ -1 +0,0 @@
-from .kubernetes_tools import kubernetes_tools
\ No newline at end of file
@@ -1,67 +1,229 @@
 #!/usr/bin/env python3
-import boto3, json, random, requests, os, signal, sys 
+import asyncio, json, os, signal, sys, time
 import redis
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 
-import click
-from ec2_metadata import ec2_metadata
-from kubernetes_tools import kubernetes_tools
-from kubernetes.client.rest import ApiException
+from json_logger import logger
+from kubernetes_tools import kubernetes_tools, async_kubernetes_tools
+from rate_limiter import rate_limiter, HIGH
+from redis_pool import redis_client
+from lazy_client import aws_client, aws_async_client
+from metrics import metrics
 
-# Global variables
-gamelift = boto3.client('gamelift', region_name=os.getenv('AWS_REGION'))
-ec2 = boto3.client('autoscaling', region_name=os.getenv('AWS_REGION'))
+# Global variables, the clients are only built by the first call that needs them
+gamelift = aws_client('gamelift')
+# The drain and health lookups run as coroutines, their calls take the high priority lane of the rate limiter
+gamelift_async = aws_async_client('gamelift', HIGH)
+autoscaling_async = aws_async_client('autoscaling', HIGH)
+
+# Number of instances handled concurrently per invocation, 1 processes the batch serially
+MONITOR_CONCURRENCY = int(os.getenv('MONITOR_CONCURRENCY', '8'))
+# DescribeAutoScalingInstances accepts at most 50 instance ids per call
+ASG_DESCRIBE_BATCH = 50
+# An instance that is not HEALTHY yet when it is initialized is parked in the monitor.deferred sorted set, scored by
+# when it is due, instead of sleeping on it. Nothing schedules the monitor by itself: due entries are picked up by the
+# next invocation SQS makes, so a retry runs INIT_RETRY_DELAY seconds later at the earliest and at the latest once
+# pubsub-service's next resync, every RESYNC_INTERVAL, reaches the queue. A taken entry is leased for
+# DEFERRED_LEASE seconds and only removed once it has been handled, so an invocation that fails or times out leaves
+# it to the next one. After INIT_MAX_ATTEMPTS the instance is left alone until pubsub-service publishes it again.
+DEFERRED_KEY = 'monitor.deferred'
+INIT_RETRY_DELAY = int(os.getenv('INIT_RETRY_DELAY', '30'))
+INIT_MAX_ATTEMPTS = int(os.getenv('INIT_MAX_ATTEMPTS', '3'))
+DEFERRED_BATCH = int(os.getenv('DEFERRED_BATCH', '100'))
+# Keep this above the function timeout, or a slow invocation's entries are handed out twice
+DEFERRED_LEASE = int(os.getenv('DEFERRED_LEASE', '900'))
 
 print_messageId=kubernetes_tools.print_messageId
 set_messageId=kubernetes_tools.set_messageId
 
+# Every worker thread and warm invocation shares the container's bounded, timed out pool with the rate limiter
 def redis_conn():
-    try:
-        r = redis.from_url('redis://' + os.getenv('REDIS_URL'))
-        if r.ping() == True:
-            print_messageId(f'Connection to database {os.getenv("REDIS_URL")} was successful', flush=True)
-    except redis.RedisError as e:
-        print_messageId(f'Could not connect to redis\n{e}', flush=True)
-    return r
-
-def is_healthy(InstanceId: str):
-    """This method calls the DescribeAutoscalingInstance API to get the health status of the instance."""
-    asg_instance = ec2.describe_auto_scaling_instances(
-        InstanceIds=[
-            InstanceId
-        ]
-    )
-    instance_health = asg_instance['AutoScalingInstances'][0]['HealthStatus']
+    return metrics.instrument_redis(redis_client('localhost:6379'))
+
+r = redis_conn()
+
+# Drain state machine of an instance, kept in the redis hash drain.<InstanceId>:
+#   ACTIVE -> CORDONED -> READY_SHUTDOWN -> DEREGISTERED -> WAITING_FOR_TERMINATION
+# A spot interruption skips ahead to DRAINED from any state once every pod has left the node.
+# Entering a state also records when it happened in a <state>_at field. A pass commits every state it got through
+# in one compare-and-set call, so concurrent workers can't skip or record a step twice.
+DRAIN_ACTIVE = 'ACTIVE'
+DRAIN_CORDONED = 'CORDONED'
+DRAIN_READY_SHUTDOWN = 'READY_SHUTDOWN'
+DRAIN_DEREGISTERED = 'DEREGISTERED'
+DRAIN_WAITING_FOR_TERMINATION = 'WAITING_FOR_TERMINATION'
+DRAIN_DRAINED = 'DRAINED'
+
+# A drain record outlives its instance when the TERMINATED message never comes, e.g. with pubsub-service running
+# without redis, so it expires DRAIN_TTL seconds after its last transition
+DRAIN_TTL = int(os.getenv('DRAIN_TTL', '86400'))
+
+# KEYS[1] drain hash, ARGV[1] expected state, ARGV[2] timestamp, ARGV[3] ttl, ARGV[4..] the states entered in order.
+# Moves through all of them in one call, recording when each was entered, the last one is the new state.
+drain_transition = r.register_script("""
+local state = redis.call('HGET', KEYS[1], 'state') or 'ACTIVE'
+if state ~= ARGV[1] then
+    return 0
+end
+for i = 4, #ARGV do
+    redis.call('HSET', KEYS[1], 'state', ARGV[i], string.lower(ARGV[i]) .. '_at', ARGV[2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+""")
+
+# KEYS[1] deferred set, ARGV[1] now, ARGV[2] max entries, ARGV[3] lease expiry. Takes the due entries and pushes them
+# to the lease expiry instead of removing them, so only one invocation retries them and a failed one leaves them behind.
+lease_deferred = r.register_script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, entry in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[3], entry)
+end
+return due
+""")
+
+def drain_key(InstanceId: str):
+    return f'drain.{InstanceId}'
+
+def read_drain_state(InstanceId: str):
+    """Reads the whole drain record of the instance in one round trip."""
+    record = {key.decode(): value.decode() for key, value in r.hgetall(drain_key(InstanceId)).items()}
+    record.setdefault('state', DRAIN_ACTIVE)
+    return record
+
+def advance_drain_state(InstanceId: str, expected: str, states):
+    """Moves the instance from expected through states in one round trip. Returns the state the instance is in
+    afterwards, which is not the last requested one if another worker moved it first."""
+    if drain_transition(keys=[drain_key(InstanceId)], args=[expected, time.time(), DRAIN_TTL] + list(states)) == 1:
+        print_messageId(f'Drain state {expected} -> {" -> ".join(states)}', flush=True)
+        return states[-1]
+    return read_drain_state(InstanceId)['state']
+
+async def describe_health(InstanceIds):
+    """This method calls the DescribeAutoscalingInstance API once per ASG_DESCRIBE_BATCH instances to get the health status
+    of a whole batch, the calls for several batches are in flight together. Returns a dict of InstanceId to HealthStatus,
+    instances unknown to the ASG are left out."""
+    InstanceIds = list(InstanceIds)
+
+    async def describe_batch(batch):
+        health = {}
+        kwargs = {'InstanceIds': batch}
+        while True:
+            page = await autoscaling_async.describe_auto_scaling_instances(**kwargs)
+            for asg_instance in page['AutoScalingInstances']:
+                health[asg_instance['InstanceId']] = asg_instance['HealthStatus']
+            if not page.get('NextToken'):
+                return health
+            kwargs['NextToken'] = page['NextToken']
+
+    batches = [InstanceIds[i:i + ASG_DESCRIBE_BATCH] for i in range(0, len(InstanceIds), ASG_DESCRIBE_BATCH)]
+    health = {}
+    for batch in await asyncio.gather(*[describe_batch(batch) for batch in batches]):
+        health.update(batch)
+    return health
+
+def is_healthy(InstanceId: str, health):
+    """Looks the instance up in the health fetched for the batch."""
+    instance_health = health.get(InstanceId, 'UNKNOWN')
     print_messageId(f'The instance is {instance_health}', flush=True)
     return instance_health 
 
+def defer(messageId, message, attempt: int):
+    """Schedules the message to be handled again in INIT_RETRY_DELAY seconds."""
+    entry = json.dumps({'messageId': messageId, 'message': message, 'attempt': attempt})
+    r.zadd(DEFERRED_KEY, {entry: time.time() + INIT_RETRY_DELAY})
+    print_messageId(f'Deferred for {INIT_RETRY_DELAY}s, attempt {attempt}', flush=True)
+
+def take_deferred():
+    """Leases the deferred messages that are due, returns them as (messageId, message, attempt, entry). Pass entry to
+    ack_deferred once the message has been handled."""
+    now = time.time()
+    try:
+        due = lease_deferred(keys=[DEFERRED_KEY], args=[now, DEFERRED_BATCH, now + DEFERRED_LEASE])
+    except redis.RedisError as e:
+        logger.warning('Could not read deferred messages', error=str(e))
+        return []
+    results = []
+    for entry in due:
+        deferred = json.loads(entry)
+        results.append((deferred['messageId'], deferred['message'], deferred['attempt'], entry))
+    return results
+
+def ack_deferred(entry):
+    try:
+        r.zrem(DEFERRED_KEY, entry)
+    except redis.RedisError as e:
+        # The lease runs out and the message is handled once more, every step of it is idempotent
+        logger.warning('Could not remove deferred message', error=str(e))
+
+def uninitialized(instances):
+    """Returns the ids of the instances whose init marker is not set, only those need their ASG health. When redis
+    cannot tell, all of them."""
+    candidates = {}
+    for InstanceId, messages in instances.items():
+        message = messages[0][1]
+        if message['InstanceStatus'] != 'TERMINATED':
+            candidates[InstanceId] = '{}.{}'.format(message['GameServerGroupName'], InstanceId)
+    if len(candidates) == 0:
+        return []
+    try:
+        pipeline = r.pipeline(transaction=False)
+        for rkey in candidates.values():
+            pipeline.exists(rkey)
+        exists = pipeline.execute()
+    except redis.RedisError as e:
+        logger.warning('Could not read init markers', error=str(e))
+        return list(candidates)
+    return [InstanceId for InstanceId, found in zip(candidates, exists) if not found]
+
+def batch_health(instances):
+    """One health lookup for the instances of the batch that may be initialized. A failed lookup only defers their
+    initialization, the health checks and drains of the batch go on."""
+    InstanceIds = uninitialized(instances)
+    if len(InstanceIds) == 0:
+        return {}
+    try:
+        return async_kubernetes_tools.run(describe_health(InstanceIds))
+    except Exception as e:
+        logger.warning('Could not describe instance health', instances=len(InstanceIds), error=str(e))
+        return {}
+
 def is_ready_shutdown_check(PrivateDnsName: str):
-    filtered_list = kubernetes_tools.get_game_servers(PrivateDnsName)
+    # Served from the GameServer cache, an empty answer is confirmed against the node before it deregisters the instance
+    filtered_list = async_kubernetes_tools.run(async_kubernetes_tools.get_game_servers(PrivateDnsName))
+    if filtered_list is None:
+        # Not knowing is not the same as none, the instance stays CORDONED until a check succeeds
+        print_messageId(f'Could not tell whether game servers are allocated on this instance', level='WARNING')
+        return False
     print_messageId(f'There are {len(filtered_list)} Allocated game servers running on this instance', flush=True)
     if filtered_list == []:
         return True   
     return False
 
-def cordon_and_protect(PrivateDnsName: str, InstanceId: str):
+async def cordon_and_protect(PrivateDnsName: str, InstanceId: str):
     """This method cordons the node, adds an toleration to all of the Agones game servers that are currently in an Allocated
-    state, and then adds a taint to the node that evits pods the don't tolerate the taint."""
-    cordon_body = {
-        "spec": {
-            "unschedulable": True
-        }
-    }
+    state, and then adds a taint to the node that evits pods the don't tolerate the taint. Returns True only when all three
+    succeeded. The taint is not added while an Allocated game server could not be given the toleration, it would evict it."""
     # Cordon the node so no new game servers are scheduled onto the instance
-    kubernetes_tools.patch_node(InstanceId, PrivateDnsName, json.dumps(cordon_body))
+    if not await async_kubernetes_tools.cordon_node(InstanceId, PrivateDnsName):
+        print_messageId(f'Could not cordon node {InstanceId}', level='WARNING')
+        return False
     toleration = {
         "effect": "NoExecute",
         "key": "gamelift.status/draining",
         "operator": "Equal",
         "value": "true"
     }
-    filtered_list = kubernetes_tools.get_game_servers(PrivateDnsName)
-    for item in filtered_list:
-        print_messageId(f"Updating {item['metadata']['namespace']}/{item['metadata']['name']} with toleration", flush=True)
-        kubernetes_tools.taint_pod(item['metadata']['name'], item['metadata']['namespace'], json.dumps(toleration))
+    # Game servers allocated up to the cordon still need the toleration, so read them from the node itself
+    try:
+        filtered_list = await async_kubernetes_tools.node_game_servers(PrivateDnsName, 'Allocated')
+    except kubernetes_tools.ApiException as e:
+        print_messageId(f'Exception when reading the game servers of {PrivateDnsName}: {e.reason}', level='WARNING')
+        return False
+    results = await async_kubernetes_tools.tolerate_pods(PrivateDnsName, filtered_list, json.dumps(toleration))
+    if any(result.startswith('error') for result in results.values()):
+        print_messageId(f'Could not add the toleration to every Allocated game server on {InstanceId}', level='WARNING')
+        return False
     
     # Change taint to DRAINING
     taint = {
@@ -69,14 +231,15 @@ def cordon_and_protect(PrivateDnsName: str, InstanceId: str):
         "value": "true",
         "effect": "NoExecute"
     }
-    return kubernetes_tools.taint_node(InstanceId, PrivateDnsName, json.dumps(taint))
+    return await async_kubernetes_tools.taint_node(InstanceId, PrivateDnsName, json.dumps(taint))
 
 
-def initialize_game_server(message):
+def initialize_game_server(message, health):
     """This method registers the instance as a game server with Gamelift FleetIQ using the instance's Id as game server name.
     After registering the instance, it looks at result of DescribeAutoscalingInstances to see whether the instance is HEALTHY. 
     When HEALTHY, the instance is CLAIMED and its status is changed to UTILIZED. Finally, the taint gamelift.aws/status:ACTIVE,NoExecute
-    is added to the node. Agones game servers need to have a toleration for this taint before they can run on this instance."""
+    is added to the node. Agones game servers need to have a toleration for this taint before they can run on this instance.
+    Returns False when the instance is not HEALTHY yet so the caller can retry it later."""
     status = message['InstanceStatus']
     GameServerGroupName = message['GameServerGroupName']
     GameServerId = message['InstanceId']
@@ -86,7 +249,7 @@ def initialize_game_server(message):
     try:
         # Register game server instance
         print_messageId(f'Registering game server {GameServerId} PrivateDnsName: {PrivateDnsName}', flush=True)  
-        gamelift.register_game_server(
+        rate_limiter.call(gamelift.register_game_server, HIGH,
             GameServerGroupName=GameServerGroupName,
             GameServerId=GameServerId,
             InstanceId=InstanceId
@@ -96,28 +259,21 @@ def initialize_game_server(message):
         #return None
     except Exception as e: 
         print_messageId(f'{e}', flush=True)
-        deregister_game_server(GameServerGroupName, GameServerId)
+        async_kubernetes_tools.run(deregister_game_server(GameServerGroupName, GameServerId))
         return None
     
     # Update the game server status to healthy
     # TODO Change this to use the new FleetIQ API DescribeGameServerInstances
-    # TODO Consider using a decorator and backoff library to implement the backoff
-    trytime = 0
-    backoff = random.randint(1,5)
-    while is_healthy(InstanceId) != 'HEALTHY':
-        print_messageId(f'Instance is not healthy, re-trying in {backoff}', flush=True)
-        sleep(backoff)
-        trytime = trytime + 1
-        # tried 3 times, let's return here
-        if trytime == 3:
-            return None
+    if is_healthy(InstanceId, health) != 'HEALTHY':
+        print_messageId(f'Instance is not healthy yet', flush=True)
+        return False
     
     update_health_status(message)
     
     # Claim the game server
     print_messageId(f'Claiming game server {GameServerId}', flush=True)
     try: 
-        gamelift.claim_game_server(
+        rate_limiter.call(gamelift.claim_game_server, HIGH,
             GameServerGroupName=GameServerGroupName,
             GameServerId=GameServerId
         )
@@ -126,11 +282,12 @@ def initialize_game_server(message):
         
     # Update game server status 
     print_messageId(f'Changing server {GameServerId} status to utilized', flush=True)
-    gamelift.update_game_server(
+    rate_limiter.call(gamelift.update_game_server, HIGH,
         GameServerGroupName=GameServerGroupName,
         GameServerId=GameServerId,
         UtilizationStatus='UTILIZED'
     )
+    return True
 
     # # Adding taint ACTIVE to node
     # taint = {
@@ -148,12 +305,12 @@ def update_health_status(message):
     PrivateDnsName = message['PrivateDnsName']
 
     try: 
-        gamelift.update_game_server(
+        rate_limiter.call(gamelift.update_game_server, HIGH,
             GameServerGroupName=GameServerGroupName,
             GameServerId=GameServerId,
             HealthCheck='HEALTHY'
         )
-        print_messageId(f'Updated Gamelift game server {GameServerId} health', flush=True)
+        print_messageId(f'Updated Gamelift game server {GameServerId} health', sample=True)
     except gamelift.exceptions.NotFoundException as e:
         print_messageId(f'Skipping healthcheck, the node {GameServerId} is not registered', flush=True)
     
@@ -163,14 +320,14 @@ def update_health_status(message):
         "value": "true",
         "effect": "NoExecute"
     }
-    kubernetes_tools.taint_node(GameServerId, PrivateDnsName, json.dumps(taint))
+    async_kubernetes_tools.run(async_kubernetes_tools.taint_node(GameServerId, PrivateDnsName, json.dumps(taint)))
     pass
 
-def deregister_game_server(GameServerGroupName: str, GameServerId: str):
+async def deregister_game_server(GameServerGroupName: str, GameServerId: str):
     """A handler for when the daemon receives a SIGTERM signal.  Before shutting down, the daemon will deregister the instance from FleetIQ."""
     # degister game server on exit
     try: 
-        gamelift.deregister_game_server(
+        await gamelift_async.deregister_game_server(
             GameServerGroupName=GameServerGroupName,
             GameServerId=GameServerId
         )
@@ -196,113 +353,157 @@ def get_health_status(message):
 
     if status == 'ACTIVE':
         return
-    global r
-    is_cordoned = (True, False)[r.hget(name="{InstanceId}", key="is_cordoned") == 1]
-    is_ready_shutdown = (True, False)[r.hget(name="{InstanceId}", key="is_cordoned") == 1]
-    is_waiting_for_termination = (True, False)[r.hget(name="{InstanceId}", key="is_cordoned") == 1]
+    record = read_drain_state(InstanceId)
+    state = record['state']
+    # Every step runs its action first and the states it got through are committed together at the end. The actions
+    # are idempotent, so a worker that dies in between only repeats them.
+    entered = []
 
-    # is_cordoned = False
-    # is_ready_shutdown = False
-    # is_waiting_for_termination = False
-
-    print_messageId('Starting message loop', flush=True)
-    print_messageId(f'is_cordoned: {is_cordoned}, is_ready_shutdown: {is_ready_shutdown}, is_waiting_for_termination: {is_waiting_for_termination}', flush=True)
-    print_messageId(f"Instance {GameServerId}/{PrivateDnsName} status is: {status}", flush=True)
+    logger.info('Checking drain state', status=status, drainState=record, node=PrivateDnsName)
 
     try:
         if status == 'DRAINING':
-            print_messageId(f'Instance is no longer viable', flush=True)
-            is_cordoned = cordon_and_protect(PrivateDnsName, GameServerId)
-            is_cordoned = True
-            r.hset(name="{InstanceId}", key="is_cordoned", value=(1, 0)[is_cordoned])
-
-            print_messageId(f'Instance should have no allocted session', flush=True)
-            is_ready_shutdown = is_ready_shutdown_check(PrivateDnsName)
-            r.hset(name="{InstanceId}", key="is_ready_shutdown", value=(1, 0)[is_ready_shutdown])
-
-            print_messageId(f'Instance should be deregistered', flush=True)
-            deregister_game_server(GameServerGroupName, GameServerId)
-            is_waiting_for_termination = True
-            r.hset(name="{InstanceId}", key="is_waiting_for_termination", value=(1, 0)[is_waiting_for_termination])
-            
-            if is_waiting_for_termination == True:
+            current = state
+            if current == DRAIN_ACTIVE:
+                print_messageId(f'Instance is no longer viable', flush=True)
+                # A node that is not fully protected stays ACTIVE, the next pass tries again
+                if async_kubernetes_tools.run(cordon_and_protect(PrivateDnsName, GameServerId)):
+                    current = DRAIN_CORDONED
+                    entered.append(current)
+
+            if current == DRAIN_CORDONED:
+                print_messageId(f'Instance should have no allocted session', flush=True)
+                if is_ready_shutdown_check(PrivateDnsName):
+                    current = DRAIN_READY_SHUTDOWN
+                    entered.append(current)
+
+            if current == DRAIN_READY_SHUTDOWN:
+                print_messageId(f'Instance should be deregistered', flush=True)
+                async_kubernetes_tools.run(deregister_game_server(GameServerGroupName, GameServerId))
+                current = DRAIN_DEREGISTERED
+                entered.append(current)
+
+            if current == DRAIN_DEREGISTERED:
+                current = DRAIN_WAITING_FOR_TERMINATION
+                entered.append(current)
+
+            if len(entered) > 0:
+                state = advance_drain_state(InstanceId, state, entered)
+
+            if state == DRAIN_WAITING_FOR_TERMINATION:
                 print_messageId(f'Waiting for termination signal', flush=True)
                 
         elif status == 'SPOT_TERMINATING':
-            if is_waiting_for_termination == True:
-                # This is never invoked because the status never equals SPOT_TERMINATING  
-                print_messageId(f'Received termination signal', flush=True)
-                kubernetes_tools.drain_pods(InstanceId, PrivateDnsName)  
+            # The watcher on the node usually got here first, every step of the handler is idempotent
+            print_messageId(f'Received termination signal', flush=True)
+            if state == DRAIN_DRAINED:
+                print_messageId(f'Node has already been drained', flush=True)
+            else:
+                termination_handler(GameServerGroupName, InstanceId, PrivateDnsName)
         else:
             pass     
 
     except Exception as e:
-        print_messageId(f'get_health_status->error: {e}', flush=True)   
-
-    # try:
-    #     if is_waiting_for_termination == True and status == 'DRAINING':
-    #         print_messageId(f'Waiting for termination signal', flush=True)
-    #     elif is_waiting_for_termination == True and status == 'SPOT_TERMINATING':
-    #         # This is never invoked because the status never equals SPOT_TERMINATING  
-    #         print_messageId(f'Received termination signal', flush=True)
-    #         kubernetes_tools.drain_pods(InstanceId, PrivateDnsName)
-    #         pass
-    #     elif is_ready_shutdown == True:
-    #         is_waiting_for_termination = deregister_game_server(GameServerGroupName, GameServerId)
-    #         #r.hset(name="{InstanceId}", key="is_waiting_for_termination", value=(1, 0)[is_waiting_for_termination])
-    #         pass
-    #     elif status == 'DRAINING' and is_cordoned == True:
-    #         # This seems to be a block call.  Delays the main loop, get_health_status, until resolved.
-    #         # I think I neeed to spawn a new thread here. 
-    #         is_ready_shutdown = is_ready_shutdown_check(PrivateDnsName)
-    #         #r.hset(name="{InstanceId}", key="is_ready_shutdown", value=(1, 0)[is_ready_shutdown])
-    #         pass
-    #     elif status == 'DRAINING' and is_cordoned == False:
-    #         print_messageId(f'Instance is no longer viable', flush=True)
-    #         is_cordoned = cordon_and_protect(PrivateDnsName, GameServerId)
-    #         #r.hset(name="{InstanceId}", key="is_cordoned", value=(1, 0)[is_cordoned])
-    #         pass
-    #     else :
-    #         pass
-    # except Exception as e:
-    #     print_messageId(f'get_health_status->error: {e}', flush=True)
-
-    print_messageId(f'is_cordoned: {is_cordoned}, is_ready_shutdown: {is_ready_shutdown}, is_waiting_for_termination: {is_waiting_for_termination}', flush=True)
-    print_messageId(f'Finished get health status loop', flush=True)
+        print_messageId(f'get_health_status->error: {e}', level='ERROR')   
+
+    logger.info('Checked drain state', status=status, drainState=state)
     pass
 
-def termination_handler(GameServerGroupName: str, GameServerId: str):
-    """This method calls the drain pods method to evict non-essential pods from the node
-    and waits to receive the termination signal from EC2 metadata."""
-    # This method is never called because the instance never receives a termination signal
+def termination_handler(GameServerGroupName: str, InstanceId: str, PrivateDnsName: str):
+    """This method runs when the instance is about to be reclaimed, either on the spot interruption notice seen by the watcher
+    or on a SPOT_TERMINATING status. It cordons and protects the node while it deregisters the game server when the group is
+    known, and then calls the drain pods method to evict non-essential pods from the node. Once every pod has left, the
+    instance is recorded as DRAINED so later SPOT_TERMINATING messages don't drain it again."""
     print_messageId(f'Shutting down', flush=True)
-    # Drain pods from the instance
+    report = async_kubernetes_tools.run(terminate(GameServerGroupName, InstanceId, PrivateDnsName))
+    if 'error' not in report and len(report['remaining']) == 0 and \
+            all(result in ('evicted', 'gone') for result in report['pods'].values()):
+        record_drained(InstanceId)
+    return report
 
-    pass
+def record_drained(InstanceId: str):
+    try:
+        state = read_drain_state(InstanceId)['state']
+        if state != DRAIN_DRAINED:
+            advance_drain_state(InstanceId, state, [DRAIN_DRAINED])
+    except redis.RedisError as e:
+        # Only costs another drain pass on the next message, which finds the node empty
+        logger.warning('Could not record the drain', error=str(e))
+
+async def terminate(GameServerGroupName: str, InstanceId: str, PrivateDnsName: str):
+    steps = [cordon_and_protect(PrivateDnsName, InstanceId)]
+    if GameServerGroupName:
+        steps.append(deregister_game_server(GameServerGroupName, InstanceId))
+    await asyncio.gather(*steps)
+    # Drain pods from the instance
+    return await async_kubernetes_tools.drain_pods(InstanceId, PrivateDnsName)
 
-r = None
-def main_loop(messageId, message):
+def main_loop(messageId, message, health, attempt=1):
     set_messageId(messageId, message['InstanceId'])
-    print_messageId(message)
-    global r
-    r = redis_conn()
+    metrics.set_group(message['GameServerGroupName'])
+    logger.debug('Received message', body=message)
     rkey = '{}.{}'.format(message['GameServerGroupName'], message['InstanceId'])
+    if message['InstanceStatus'] == 'TERMINATED':
+        # pubsub-service publishes this once when the instance leaves its game server group
+        print_messageId(f'Instance {message["InstanceId"]} is gone, forgetting it', flush=True)
+        r.delete(rkey, drain_key(message['InstanceId']))
+        return
     if r.setnx(rkey, '1') == True:
         print_messageId(f'access {rkey}')
-        initialize_game_server(message)
+        if initialize_game_server(message, health) == False:
+            # Release the marker so the retry, or the next message of the instance, initializes it again
+            r.delete(rkey)
+            if attempt < INIT_MAX_ATTEMPTS:
+                defer(messageId, message, attempt + 1)
+            else:
+                print_messageId(f'Giving up on initializing {message["InstanceId"]} after {attempt} attempts', flush=True)
+            # An instance that is not HEALTHY gets neither the GameLift health check nor the active taint. Its drain,
+            # if it is already being reclaimed, still moves on.
+            get_health_status(message)
+            return
     
     update_health_status(message)
     get_health_status(message)
     pass
 
+def process_instance(messages, health):
+    """Handles the messages of one instance in the order they were received. Deferred messages are acknowledged once
+    handled, a message that raises stops the instance and leaves its deferred entries leased."""
+    for messageId, message, attempt, entry in messages:
+        main_loop(messageId, message, health, attempt)
+        if entry is not None:
+            ack_deferred(entry)
+
+@logger.flushing
+@metrics.emitting
 def lambda_handler(event, context):
-    print(f'ALL START!!!', flush=True) 
 
+
+    # Messages of the same instance stay in order on one worker, different instances run concurrently.
+    # Deferred messages are older than the ones in the batch so they go first.
+    instances = {}
+    for messageId, message, attempt, entry in take_deferred():
+        instances.setdefault(message['InstanceId'], []).append((messageId, message, attempt, entry))
     for record in event['Records']:
         for message in json.loads(record['body']):
-            main_loop(record["messageId"], message)
+            instances.setdefault(message['InstanceId'], []).append((record["messageId"], message, 1, None))
+
+    health = batch_health(instances)
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, min(MONITOR_CONCURRENCY, len(instances)))) as executor:
+        futures = {executor.submit(process_instance, messages, health): InstanceId for InstanceId, messages in instances.items()}
+        for future, InstanceId in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error('Processing instance failed', instanceId=InstanceId, error=str(e))
+                errors.append(e)
+    # Fail the invocation so SQS redelivers the batch, the same way a serial failure did
+    if len(errors) > 0:
+        raise errors[0]
     
-    print(f'ALL DONE!!!', flush=True) 
+    logger.info('Processed batch', instances=len(instances), records=len(event['Records']))
     # TODO implement
     return {
         'statusCode': 200,
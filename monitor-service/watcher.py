@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import os, requests
+from time import sleep
+
+import click
+from ec2_metadata import ec2_metadata
+from json_logger import logger
+from lambda_function import termination_handler, print_messageId, set_messageId
+
+# Seconds between two spot interruption checks of the watcher, IMDS is local so polling it is cheap
+SPOT_WATCH_INTERVAL = float(os.getenv('SPOT_WATCH_INTERVAL', '1'))
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option('--group', default=lambda: os.getenv('GAME_SERVER_GROUP_NAME'), help='Game server group of this instance, the game server is deregistered from it on interruption.')
+@click.option('--interval', default=SPOT_WATCH_INTERVAL, show_default=True, help='Seconds between two checks.')
+def watch(group, interval):
+    """Runs on the instance and polls the spot interruption notice in IMDS. On a notice the node is cordoned, protected and
+    drained right away instead of waiting for pubsub-service to see SPOT_TERMINATING."""
+    # One session for the life of the watcher, so every check reuses the same keep-alive connection and IMDSv2 token.
+    # Nothing restarts the watcher, so no failure may end the loop before the node has been drained, that includes
+    # reading the identity of the instance.
+    identity = None
+    while True:
+        if identity is None:
+            try:
+                identity = ec2_metadata.snapshot(('instance_id', 'private_hostname'))
+                InstanceId = identity.instance_id
+                PrivateDnsName = identity.private_hostname
+                set_messageId('watch', InstanceId)
+                print_messageId(f'Watching spot interruptions of {InstanceId}/{PrivateDnsName}', flush=True)
+            except Exception as e:
+                print_messageId(f'Could not read the instance identity: {e}', level='WARNING')
+                ec2_metadata.reset_token()
+                identity = None
+                logger.flush()
+                sleep(interval)
+                continue
+        try:
+            notice = ec2_metadata.spot_instance_action
+        except requests.RequestException as e:
+            # Also covers an expired or revoked token, drop it so the next check asks for a new one
+            print_messageId(f'Could not read spot instance action: {e}', level='WARNING')
+            ec2_metadata.reset_token()
+            notice = None
+        except Exception as e:
+            # e.g. a notice that is not valid JSON
+            print_messageId(f'Could not parse spot instance action: {e}', level='WARNING')
+            notice = None
+        if notice is not None:
+            print_messageId(f'Spot interruption notice: {notice}', flush=True)
+            try:
+                print_messageId(f'{termination_handler(group, InstanceId, PrivateDnsName)}', flush=True)
+                logger.flush()
+                return
+            except Exception as e:
+                # Every step of the handler is idempotent, try the whole of it again on the next check
+                print_messageId(f'Termination handler failed, retrying: {e}', level='ERROR')
+        # The watcher never returns to a handler, write out what the check logged
+        logger.flush()
+        sleep(interval)
+
+if __name__ == '__main__':
+    cli()
@@ -1,27 +1,200 @@
-import json, os, time
-import boto3
-import logging
-import random
+import json, os, time, hashlib, zlib
+import redis
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-logging.basicConfig(level=logging.INFO)
+from instance_cache import instance_cache
+from json_logger import logger
+from lazy_client import aws_client
+from metrics import metrics
+from redis_pool import redis_client
+from rate_limiter import rate_limiter, HIGH
 
-sqs = boto3.resource('sqs')
-ec2 = boto3.client('ec2', region_name=os.getenv('AWS_REGION'))
+sqs = aws_client('sqs')
+gamelift = aws_client('gamelift')
 sqsName = 'message.fifo'
+# Without redis there is no snapshot to diff against and every tick is a full resync
+r = metrics.instrument_redis(redis_client())
 
-    
-def decribe_instance(game_server):
-    print(f'{game_server["InstanceId"]}:{game_server["InstanceStatus"]}', flush=True)
-    Reservations = ec2.describe_instances(InstanceIds=[game_server["InstanceId"]]).get("Reservations")
-    #print(json.dumps(Reservations), flush=True)
-    for reservation in Reservations:
-        for instance in reservation['Instances']:
-            game_server["PrivateDnsName"] = instance.get("PrivateDnsName")
-            game_server["PrivateIpAddress"] = instance.get("PrivateIpAddress")
-            game_server["PublicDnsName"] = instance.get("PublicDnsName")
-            game_server["PublicIpAddress"] = instance.get("PublicIpAddress") 
-            
-    return game_server
+# Only status transitions are published, plus a full resync of each group every RESYNC_INTERVAL seconds.
+# The monitor heartbeats GameLift for every message it receives and GameLift expects a health check about every
+# 60 seconds, so keep this at or below that. With the heartbeat riding on the resync a stable fleet still publishes
+# every instance once a minute, which on a 30 second schedule is about half of what publishing every tick sent.
+RESYNC_INTERVAL = int(os.getenv('RESYNC_INTERVAL', '60'))
+# Scheduled ticks don't start exactly RESYNC_INTERVAL apart, a resync is due once this close to the interval
+RESYNC_SLACK = float(os.getenv('RESYNC_SLACK', '10'))
+# Instances in these states are published on every tick, the monitor advances their drain on each message
+DRAINING_STATUSES = ('DRAINING', 'SPOT_TERMINATING')
+# Pseudo status published for instances that are no longer part of their game server group
+TERMINATED = 'TERMINATED'
+# SQS rejects message bodies and SendMessageBatch requests above 256 KiB, and batches above 10 entries
+SQS_MAX_BYTES = 262144
+SQS_MAX_BATCH = 10
+# MessageGroupId of the status messages. 'instance' keeps the updates of each instance in order while different
+# instances are consumed in parallel, 'shard' spreads a group over MESSAGE_GROUP_SHARDS ordered lanes and 'group'
+# serializes the whole group like before.
+MESSAGE_GROUP_KEY = os.getenv('MESSAGE_GROUP_KEY', 'instance')
+MESSAGE_GROUP_SHARDS = int(os.getenv('MESSAGE_GROUP_SHARDS', '16'))
+
+# Game server groups are polled concurrently, on top of that each AWS service gets its own cap on in-flight calls
+# so a dozen groups don't hit the GameLift throttling limit at once. The EC2 cap lives in instance_cache.
+GROUP_CONCURRENCY = int(os.getenv('GROUP_CONCURRENCY', '8'))
+service_limits = {
+    'gamelift': threading.BoundedSemaphore(int(os.getenv('GAMELIFT_CONCURRENCY', '4'))),
+    'sqs': threading.BoundedSemaphore(int(os.getenv('SQS_CONCURRENCY', '8'))),
+}
+
+def describe_game_server_instances(group: str):
+    """Yields the DescribeGameServerInstances pages of a group, holding a gamelift slot only while a page is fetched.
+    Pages are fetched under the shared rate limit at high priority, the drains depend on them."""
+    kwargs = {'GameServerGroupName': group}
+    while True:
+        with service_limits['gamelift']:
+            page = rate_limiter.call(gamelift.describe_game_server_instances, HIGH, **kwargs)
+        yield page
+        if not page.get('NextToken'):
+            return
+        kwargs['NextToken'] = page['NextToken']
+
+def message_group_id(group: str, game_server):
+    if MESSAGE_GROUP_KEY == 'instance':
+        return f'{group}.{game_server["InstanceId"]}'
+    if MESSAGE_GROUP_KEY == 'shard':
+        shard = zlib.crc32(game_server["InstanceId"].encode()) % MESSAGE_GROUP_SHARDS
+        return f'{group}.{shard}'
+    return group
+
+def pack_messages(group: str, game_servers):
+    """Packs game servers into message bodies of at most SQS_MAX_BYTES, a body never mixes message groups.
+    Returns a list of (MessageGroupId, MessageBody)."""
+    lanes = {}
+    for game_server in game_servers:
+        lanes.setdefault(message_group_id(group, game_server), []).append(json.dumps(game_server))
+
+    messages = []
+    for MessageGroupId, items in lanes.items():
+        # A body is '[' + ', '.join(items) + ']', the same text json.dumps produces for the list
+        body, size = [], 2
+        for item in items:
+            item_size = len(item.encode()) + 2
+            if len(body) > 0 and size + item_size > SQS_MAX_BYTES:
+                messages.append((MessageGroupId, '[' + ', '.join(body) + ']'))
+                body, size = [], 2
+            body.append(item)
+            size += item_size
+        if len(body) > 0:
+            messages.append((MessageGroupId, '[' + ', '.join(body) + ']'))
+    return messages
+
+def send_batch(queue_url: str, entries):
+    with service_limits['sqs']:
+        response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+    logger.info('Sent messages', sent=len(response.get("Successful", [])))
+    if len(response.get('Failed', [])) > 0:
+        raise RuntimeError(f'SendMessageBatch failed for {response["Failed"]}')
+
+def send_game_servers(queue_url: str, group: str, game_servers, tick: str):
+    """Publishes game servers with SendMessageBatch, filling each batch up to SQS_MAX_BATCH entries or SQS_MAX_BYTES.
+    The deduplication id is derived from the tick and the content, so a retried tick is deduplicated by SQS while the
+    same status published again on a later tick is not."""
+    entries, size = [], 0
+    for MessageGroupId, MessageBody in pack_messages(group, game_servers):
+        body_size = len(MessageBody.encode())
+        if len(entries) == SQS_MAX_BATCH or (len(entries) > 0 and size + body_size > SQS_MAX_BYTES):
+            send_batch(queue_url, entries)
+            entries, size = [], 0
+        entries.append({
+            'Id': str(len(entries)),
+            'MessageBody': MessageBody,
+            'MessageGroupId': MessageGroupId,
+            'MessageDeduplicationId': hashlib.sha256(f'{tick}.{MessageGroupId}.{MessageBody}'.encode()).hexdigest()
+        })
+        size += body_size
+    if len(entries) > 0:
+        send_batch(queue_url, entries)
+
+def load_snapshot(group: str, started: float):
+    """Returns the last published game server of every instance in the group, and whether this tick is a full resync.
+    The resync marker holds the start of the tick that last resynced, a resync is due once RESYNC_INTERVAL has passed
+    since then, give or take RESYNC_SLACK."""
+    if r is None:
+        return {}, True
+    try:
+        resynced_at = r.get(f'pubsub.resync.{group}')
+        resync = resynced_at is None or started - float(resynced_at) >= RESYNC_INTERVAL - RESYNC_SLACK
+        snapshot = r.hgetall(f'pubsub.snapshot.{group}')
+    except redis.RedisError as e:
+        logger.warning('Could not load the snapshot, publishing everything', error=str(e))
+        return {}, True
+    return {InstanceId.decode(): json.loads(game_server) for InstanceId, game_server in snapshot.items()}, resync
+
+def mark_resynced(group: str, started: float):
+    """Only set once the resync was published, so a failed tick resyncs again on the next one. Records when the tick
+    started rather than when the publish ended, so a slow resync doesn't push the next one back by a whole tick."""
+    if r is None:
+        return
+    try:
+        r.set(f'pubsub.resync.{group}', started, ex=RESYNC_INTERVAL * 2)
+    except redis.RedisError as e:
+        logger.warning('Could not mark the resync', error=str(e))
+
+def save_snapshot(group: str, game_servers, disappeared):
+    if r is None:
+        return
+    try:
+        pipeline = r.pipeline(transaction=False)
+        if len(game_servers) > 0:
+            pipeline.hset(f'pubsub.snapshot.{group}', mapping={game_server["InstanceId"]: json.dumps(game_server) for game_server in game_servers})
+        if len(disappeared) > 0:
+            pipeline.hdel(f'pubsub.snapshot.{group}', *disappeared)
+        pipeline.execute()
+    except redis.RedisError as e:
+        logger.warning('Could not save the snapshot', error=str(e))
+
+def poll_group(queue_url: str, group: str, tick: str):
+    """Paginates, enriches and publishes one game server group. Only new instances and instances whose InstanceStatus
+    changed since the last tick are published, instances that left the group are published once as TERMINATED.
+    Draining instances are published on every tick so their drain keeps moving.
+    The snapshot is only updated after a publish succeeded, so a failed tick is retried on the next one.
+    Returns the number of game servers published."""
+    logger.bind(group=group, tick=tick)
+    metrics.set_group(group)
+    started = time.time()
+    snapshot, resync = load_snapshot(group, started)
+    if resync:
+        logger.info('Full resync of game server group')
+    seen = set()
+    published = 0
+    for page in describe_game_server_instances(group):
+        game_servers = []
+        for game_server in instance_cache.describe_instances(page['GameServerInstances']):
+            logger.info('Game server status', sample=True, instanceId=game_server["InstanceId"], status=game_server["InstanceStatus"])
+            if not game_server.get('PrivateDnsName'):
+                continue
+            seen.add(game_server["InstanceId"])
+            last_seen = snapshot.get(game_server["InstanceId"])
+            if (resync or last_seen is None or last_seen["InstanceStatus"] != game_server["InstanceStatus"]
+                    or game_server["InstanceStatus"] in DRAINING_STATUSES):
+                logger.info('Publishing status', instanceId=game_server["InstanceId"], status=game_server["InstanceStatus"])
+                game_servers.append(game_server)
+
+        if len(game_servers) == 0:
+            continue
+        send_game_servers(queue_url, group, game_servers, tick)
+        save_snapshot(group, game_servers, [])
+        published += len(game_servers)
+
+    disappeared = [InstanceId for InstanceId in snapshot if InstanceId not in seen]
+    if len(disappeared) > 0:
+        game_servers = [dict(snapshot[InstanceId], InstanceStatus=TERMINATED) for InstanceId in disappeared]
+        logger.info('Instances left game server group', instanceIds=disappeared)
+        send_game_servers(queue_url, group, game_servers, tick)
+        save_snapshot(group, [], disappeared)
+        instance_cache.evict(disappeared)
+        published += len(game_servers)
+    if resync:
+        mark_resynced(group, started)
+    return published
 
 """
     Current status of the game server instance.
@@ -30,35 +203,27 @@ def decribe_instance(game_server):
         DRAINING -- The instance is not viable for hosting game servers. Existing game servers are in the process of ending, and new game servers are not started on this instance unless no other resources are available. When the instance is put in DRAINING, a new instance is started up to replace it. Once the instance has no UTILIZED game servers, it will be terminated in favor of the new instance.
         SPOT_TERMINATING -- The instance is in the process of shutting down due to a Spot instance interruption. No new game servers are started on this instance.
 """          
+@logger.flushing
+@metrics.emitting
 def lambda_handler(event, context):
  
-    queue = sqs.get_queue_by_name(QueueName=sqsName)
+    queue_url = sqs.get_queue_url(QueueName=sqsName)['QueueUrl']
     
-    gamelift = boto3.client('gamelift', region_name=os.getenv('AWS_REGION'))
-    paginator = gamelift.get_paginator('describe_game_server_instances')
     #TODO get GAME_SERVER_GROUP_NAME from a ConfigMap and loop through the values
-    groups = json.loads(os.getenv('CONFIG_TXT'))
-    for group in groups['GameServerGroups']:
-        pages = paginator.paginate(GameServerGroupName=group)
-        for page in pages:
-            game_servers = []
-            for game_server in page['GameServerInstances']:
-                
-                game_server = decribe_instance(game_server)
-                if 'PrivateDnsName' in game_server and len(game_server['PrivateDnsName']) > 0:
-                    print(f'Publishing status on channel {game_server["InstanceId"]}', flush=True)
-                    game_servers.append(game_server)
-
-            if len(game_servers) == 0:
-                continue
-            randomsuffix = str(random.randint(1,1000))
-            response = queue.send_message(
-                MessageBody=json.dumps(game_servers), 
-                MessageGroupId=group, 
-                MessageDeduplicationId=group + randomsuffix)
-                
-            print(f'response = {response}')        
+    groups = json.loads(os.getenv('CONFIG_TXT'))['GameServerGroups']
+    # A slow or throttled group only fails its own entry, the others are published as soon as they are ready
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(GROUP_CONCURRENCY, len(groups)))) as executor:
+        futures = {executor.submit(poll_group, queue_url, group, context.aws_request_id): group for group in groups}
+        for future in as_completed(futures):
+            group = futures[future]
+            try:
+                results[group] = {'published': future.result()}
+            except Exception as e:
+                logger.error('Polling game server group failed', group=group, error=str(e))
+                results[group] = {'error': str(e)}
+
     return {
         'statusCode': 200,
-        'body': json.dumps('Hello from Lambda!')
+        'body': json.dumps(results)
     }
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Runs monitor-service's ec2_metadata against the local FakeIMDS: a snapshot, the per-attribute TTLs, the spot
+interruption notice the watcher polls and the IMDSv2 token handling. Exits non-zero on the first check that fails.
+
+    python script/imds_check.py
+"""
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'monitor-service'))
+
+from ec2_metadata.ec2_metadata import EC2Metadata
+from ec2_metadata.fake_imds import DEFAULT_PATHS, FakeIMDS
+
+NOTICE = {'action': 'terminate', 'time': '2026-01-01T00:00:00Z'}
+
+def check(condition: bool, message: str):
+    if not condition:
+        raise AssertionError(message)
+    print(f'ok  {message}')
+
+def main():
+    server = FakeIMDS().start()
+    try:
+        metadata = EC2Metadata(service_url=server.url, ttls={'public_ipv4': 0.2})
+
+        snapshot = metadata.snapshot()
+        check(snapshot.instance_id == 'i-0123456789abcdef0', 'snapshot reads the instance id')
+        check(snapshot.region == 'us-east-1', 'snapshot reads the region from the identity document')
+        check(snapshot.private_hostname == DEFAULT_PATHS['meta-data/local-hostname'], 'snapshot reads the private hostname')
+        check(snapshot.spot_instance_action is None, 'no spot notice is None, not an error')
+
+        requests = server.requests
+        metadata.snapshot(('instance_id', 'private_hostname'))
+        check(server.requests == requests, 'values without a TTL are served from the cache')
+
+        metadata.public_ipv4
+        requests = server.requests
+        metadata.public_ipv4
+        check(server.requests == requests, 'a ttls override caches within its TTL')
+        time.sleep(0.3)
+        metadata.public_ipv4
+        check(server.requests == requests + 1, 'a ttls override expires after its TTL')
+
+        server.paths['meta-data/spot/instance-action'] = json.dumps(NOTICE)
+        check(metadata.spot_instance_action == NOTICE, 'spot_instance_action is never cached and sees a new notice')
+        del server.paths['meta-data/spot/instance-action']
+        check(metadata.spot_instance_action is None, 'spot_instance_action sees the notice go away')
+
+        server.tokens.clear()
+        metadata.reset_token()
+        check(metadata.spot_instance_action is None, 'reset_token() gets a new token after the old one was revoked')
+
+        metadata.clear_all()
+        requests = server.requests
+        metadata.instance_id
+        check(server.requests == requests + 1, 'clear_all() forgets the cached values')
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except AssertionError as e:
+        print(f'FAIL {e}')
+        sys.exit(1)
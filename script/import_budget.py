@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Import-time profile of each lambda handler, checked against a cold-start budget.
+
+Imports lambda_function of every service in a fresh interpreter with `python -X importtime`, several times, and
+keeps the fastest run. It fails when a handler takes longer than its budget or pulls in one of the packages that
+are only supposed to be imported on first use.
+
+    python script/import_budget.py
+    python script/import_budget.py --services monitor-service --budget-ms 300 --top 15
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ('pubsub-service', 'monitor-service', 'wrapper-service')
+# Built lazily by lazy_client and kubernetes_tools, or only used by the spot watcher
+DEFERRED = ('boto3', 'botocore', 'kubernetes', 'aiohttp', 'click', 'ec2_metadata')
+# The handlers build their clients from these at import time, any value will do
+DUMMY_ENV = {
+    'AWS_REGION': 'us-east-1',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'kube_url': 'https://127.0.0.1',
+    'kube_token': 'token',
+}
+
+def profile(service: str):
+    """Returns {module: (self_us, cumulative_us, depth)} of one import of the service's handler."""
+    env = dict(DUMMY_ENV, **os.environ)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import lambda_function'],
+        cwd=os.path.join(ROOT, service), env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'Importing the {service} handler failed\n{result.stderr}')
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules[name.strip()] = (int(self_us), int(cumulative_us), depth)
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of the lambda handlers against a budget.')
+    parser.add_argument('--services', nargs='+', default=SERVICES)
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('IMPORT_BUDGET_MS', '500')))
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    failed = False
+    for service in args.services:
+        runs = [profile(service) for _ in range(args.runs)]
+        modules = min(runs, key=lambda modules: modules['lambda_function'][1])
+        total_ms = modules['lambda_function'][1] / 1000
+        over = total_ms > args.budget_ms
+        eager = sorted({name.split('.')[0] for name in modules} & set(DEFERRED))
+        print(f'{service}: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms){" OVER BUDGET" if over else ""}')
+        # The imports lambda_function itself triggers, heaviest first
+        direct = [(name, cumulative) for name, (_, cumulative, depth) in modules.items() if depth == 1]
+        for name, cumulative in sorted(direct, key=lambda item: -item[1])[:args.top]:
+            print(f'    {cumulative / 1000:8.1f} ms  {name}')
+        if len(eager) > 0:
+            print(f'    imported eagerly: {", ".join(eager)}')
+        failed = failed or over or len(eager) > 0
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
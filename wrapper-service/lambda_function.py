@@ -1,23 +1,56 @@
 #!/usr/bin/env python3
-import boto3, json, random, requests, os, signal, sys 
+import asyncio, json, math, random, os, signal, sys, time, hashlib
+import redis
 from time import sleep
 
-from kubernetes_tools import kubernetes_tools
-from kubernetes.client.rest import ApiException
+from kubernetes_tools import kubernetes_tools, async_kubernetes_tools
+from instance_cache import instance_cache
+from json_logger import logger
+from rate_limiter import rate_limiter, RateLimited, HIGH, LOW
+from lazy_client import aws_client
+from metrics import metrics
+from redis_pool import redis_client
 
 # Global variables
-gamelift = boto3.client('gamelift', region_name=os.getenv('AWS_REGION'))
-ec2 = boto3.client('ec2', region_name=os.getenv('AWS_REGION'))
-autoscaling = boto3.client('autoscaling', region_name=os.getenv('AWS_REGION'))
+# Clients and the Kubernetes API are only set up by the first action that needs them
+gamelift = aws_client('gamelift')
+autoscaling = aws_client('autoscaling')
+
+# GameServerAllocations in flight at once when allocating in batch, they share one event loop
+ALLOCATION_CONCURRENCY = int(os.getenv('ALLOCATION_CONCURRENCY', '10'))
+# Default page size of list_game_server
+LIST_PAGE_LIMIT = int(os.getenv('LIST_PAGE_LIMIT', '100'))
+# Responses of read actions are kept in redis for RESPONSE_CACHE_TTL seconds so dashboard polls in between are
+# answered without touching GameLift, EC2 or the Kubernetes API
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '5'))
+cached_actions = ('describe_game_server_instances', 'list_node', 'read_namespaced_pod', 'list_game_server')
+r = metrics.instrument_redis(redis_client())
 
 print_messageId=kubernetes_tools.print_messageId
 set_messageId=kubernetes_tools.set_messageId
 
+class BackendError(Exception):
+    """Raised by an action whose backend call failed. Answered with a 502 and never cached."""
+
+class BadRequest(Exception):
+    """Raised by an action whose query string parameters are malformed. Answered with a 400."""
+
+def int_param(params, name: str, default: int):
+    """A positive integer query string parameter."""
+    value = params.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f'{name} must be an integer, got {value!r}')
+    if value < 1:
+        raise BadRequest(f'{name} must be at least 1, got {value}')
+    return value
+
 def deregister_game_server(GameServerGroupName: str, GameServerId: str):
     """A handler for when the daemon receives a SIGTERM signal.  Before shutting down, the daemon will deregister the instance from FleetIQ."""
     # degister game server on exit
     try: 
-        gamelift.deregister_game_server(
+        rate_limiter.call(gamelift.deregister_game_server, HIGH,
             GameServerGroupName=GameServerGroupName,
             GameServerId=GameServerId
         )
@@ -27,89 +60,115 @@ def deregister_game_server(GameServerGroupName: str, GameServerId: str):
         print_messageId(f'Instance {GameServerId} has already been deregistered', flush=True)
     return False
 
-def decribe_instance(game_server):
-    print_messageId(f'{game_server["InstanceId"]}:{game_server["InstanceStatus"]}', flush=True)
-    Reservations = ec2.describe_instances(InstanceIds=[game_server["InstanceId"]]).get("Reservations")
-    #print(json.dumps(Reservations), flush=True)
-
-    for reservation in Reservations:
-        for instance in reservation['Instances']:
-            game_server["PrivateDnsName"] = instance.get("PrivateDnsName")
-            game_server["PrivateIpAddress"] = instance.get("PrivateIpAddress")
-            game_server["PublicDnsName"] = instance.get("PublicDnsName")
-            game_server["PublicIpAddress"] = instance.get("PublicIpAddress") 
-            
-    return game_server
-    
+def game_server_instance_pages(group: str):
+    """Yields the DescribeGameServerInstances pages of a group. Dashboard reads take the low priority lane of the shared
+    rate limit so they never crowd out heartbeats and drains."""
+    kwargs = {'GameServerGroupName': group}
+    while True:
+        page = rate_limiter.call(gamelift.describe_game_server_instances, LOW, **kwargs)
+        yield page
+        if not page.get('NextToken'):
+            return
+        kwargs['NextToken'] = page['NextToken']
+
 def describe_game_server_instances(params):
     group = params.get('group')
-    paginator = gamelift.get_paginator('describe_game_server_instances')
-    pages = paginator.paginate(GameServerGroupName=group)
     
     results = []
-    for page in pages:
-        for game_server in page['GameServerInstances']:
-            game_server = decribe_instance(game_server)
-            if 'PrivateDnsName' in game_server and len(game_server['PrivateDnsName']) > 0:
+    for page in game_server_instance_pages(group):
+        for game_server in instance_cache.describe_instances(page['GameServerInstances'], LOW):
+            logger.info('Game server status', sample=True, instanceId=game_server["InstanceId"], status=game_server["InstanceStatus"])
+            if game_server.get('PrivateDnsName'):
                 results.append(game_server)
     
     return results      
 
 def deregister_game_server_instances(params):
     group = params.get('group')
-    paginator = gamelift.get_paginator('describe_game_server_instances')
-    pages = paginator.paginate(GameServerGroupName=group)
 
     results = []
-    for page in pages:
+    for page in game_server_instance_pages(group):
         for game_server in page['GameServerInstances']:
             if game_server["InstanceStatus"] != 'ACTIVE':
                 if deregister_game_server(group, game_server["InstanceId"]) == True:
                     pass
                 results.append(game_server["InstanceId"])        
+    # Deregistered instances are on their way out, don't keep serving their network identity
+    instance_cache.evict(results)
     return results
 
 def list_node(params):
+    """Joins the game server instances of the group with the cluster nodes by private DNS name. The nodes come from a single
+    list_node call, optionally narrowed by the selector parameter. An instance without a node is returned with status missing
+    instead of aborting the whole listing."""
     results = describe_game_server_instances(params)
+    kwargs = {}
+    if params.get('selector'):
+        kwargs['label_selector'] = params.get('selector')
+    try: 
+        node_list = kubernetes_tools.core_v1_client.list_node(**kwargs)
+    except kubernetes_tools.ApiException as e:
+        print_messageId(f'Exception when calling CoreV1Api->list_node: {e}\n', level='WARNING')
+        raise BackendError(f'Could not list nodes: {e.reason}')
+    nodes_by_name = {node.metadata.name: node for node in node_list.items}
+
     nodes = []
     for game_server in results:
-        if 'PrivateDnsName' in game_server:
-            PrivateDnsName = game_server["PrivateDnsName"]
-            try: 
-                node = kubernetes_tools.core_v1_client.read_node(PrivateDnsName)
-            except ApiException as e:
-                print_messageId(f'Exception when calling CoreV1Api->read_node: {e}\n', flush=True)
-                return False
-            if node.spec is None:
-                continue
-            nn = {}
-            nn['node_name'] = PrivateDnsName
-            nn['instance_id'] = game_server["InstanceId"]
-            nn['taints'] = []
-            for taint in node.spec.taints:
-                tt = {}
-                tt['node_name'] = PrivateDnsName
-                tt['effect'] = taint.effect
-                tt['key'] = taint.key
-                tt['value'] = taint.value
-                nn['taints'].append(tt)
+        PrivateDnsName = game_server["PrivateDnsName"]
+        node = nodes_by_name.get(PrivateDnsName)
+        nn = {}
+        nn['node_name'] = PrivateDnsName
+        nn['instance_id'] = game_server["InstanceId"]
+        nn['status'] = 'found'
+        nn['taints'] = []
+        if node is None or node.spec is None:
+            nn['status'] = 'missing'
             nodes.append(nn)
+            continue
+        for taint in node.spec.taints or []:
+            tt = {}
+            tt['node_name'] = PrivateDnsName
+            tt['effect'] = taint.effect
+            tt['key'] = taint.key
+            tt['value'] = taint.value
+            nn['taints'].append(tt)
+        nodes.append(nn)
 
     return nodes
-    pass
 
 def read_namespaced_pod(params):
-    custom_objs = list_cluster_custom_object_all()
-    
-    pods = []
+    """Lists the game server pods with a single call selected by the agones.dev/gameserver label and joins them with the
+    GameServers in memory. The optional namespace and node parameters narrow the pod list, fleet narrows the GameServers."""
+    namespace = params.get('namespace')
+    node = params.get('node')
+    fleet = params.get('fleet')
+
+    custom_objs = list_cluster_custom_object_all(label_selector='agones.dev/fleet=' + fleet if fleet else None)
+    if custom_objs is None:
+        raise BackendError('Could not list game servers')
+    game_servers = {}
     for item in custom_objs['items']:
-        PodName = item['metadata']['name']
-        PodNamespace = item['metadata']['namespace']
-        try:
-            pod = kubernetes_tools.core_v1_client.read_namespaced_pod(name=PodName, namespace=PodNamespace)
-            print(pod.spec.tolerations)
-        except ApiException as e:
-            print_messageId(f'Exception when calling CoreV1Api->read_namespaced_pod: {e}\n', flush=True)
+        game_servers['{}/{}'.format(item['metadata']['namespace'], item['metadata']['name'])] = item
+
+    kwargs = {'label_selector': 'agones.dev/gameserver'}
+    if node:
+        kwargs['field_selector'] = 'spec.nodeName=' + node
+    try:
+        if namespace:
+            pod_list = kubernetes_tools.core_v1_client.list_namespaced_pod(namespace, **kwargs)
+        else:
+            pod_list = kubernetes_tools.core_v1_client.list_pod_for_all_namespaces(**kwargs)
+    except kubernetes_tools.ApiException as e:
+        print_messageId(f'Exception when calling CoreV1Api->list_pod_for_all_namespaces: {e}\n', level='WARNING')
+        raise BackendError(f'Could not list pods: {e.reason}')
+
+    pods = []
+    for pod in pod_list.items:
+        PodNamespace = pod.metadata.namespace
+        PodName = pod.metadata.labels['agones.dev/gameserver']
+        item = game_servers.get(f'{PodNamespace}/{PodName}')
+        if item is None:
+            continue
 
         pp = {}
         pp['node_name'] = pod.spec.node_name
@@ -117,8 +176,10 @@ def read_namespaced_pod(params):
         pp['namespace'] = PodNamespace
         pp['name'] = pod.metadata.name
         pp['labels'] = pod.metadata.labels
+        pp['state'] = item.get('status', {}).get('state')
+        pp['fleet'] = item['metadata'].get('labels', {}).get('agones.dev/fleet')
         pp['tolerations'] = []
-        for toler in pod.spec.tolerations:
+        for toler in pod.spec.tolerations or []:
             tt = {}
             tt['effect'] = toler.effect
             tt['operator'] = toler.operator
@@ -129,65 +190,139 @@ def read_namespaced_pod(params):
         pods.append(pp)
 
     return pods
-    pass
 
 def delete_namespaced_pod(params):
     PodName = params.get('name')
     try:
         pod = kubernetes_tools.core_v1_client.delete_namespaced_pod(name=PodName, namespace="default")
-        print(pod)
-    except ApiException as e:
-        print_messageId(f'Exception when calling CoreV1Api->read_namespaced_pod: {e}\n', flush=True)
+        logger.debug('Deleted pod', pod=pod)
+    except kubernetes_tools.ApiException as e:
+        print_messageId(f'Exception when calling CoreV1Api->read_namespaced_pod: {e}\n', level='WARNING')
 
     return {"podname": PodName}
     pass
 
+def project(item, fields):
+    """Keeps only the given dot separated paths of an object, e.g. status.state."""
+    projected = {}
+    for field in fields:
+        value = item
+        for part in field.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        projected[field] = value
+    return projected
+
 def list_game_server(params):
-    custom_objs = list_cluster_custom_object_all()
-    if custom_objs is None:
-        return []  
-    game_servers = custom_objs['items']
-    return list(map(lambda x: x['status'], game_servers))
-    pass
+    """Returns one page of GameServers: limit objects (default LIST_PAGE_LIMIT) starting at the continue token.
+    fleet is passed to the API server as a label selector. state is applied to each page as it is read, because
+    custom resources can't be field-selected on status. fields is a comma separated list of paths to return,
+    e.g. status.state,status.nodeName,status.address,status.ports. Without it each item is the GameServer status."""
+    kwargs = {'limit': int_param(params, 'limit', LIST_PAGE_LIMIT)}
+    if params.get('continue'):
+        kwargs['_continue'] = params.get('continue')
+    if params.get('fleet'):
+        kwargs['label_selector'] = 'agones.dev/fleet=' + params.get('fleet')
+    try:
+        custom_objs = async_kubernetes_tools.run(async_kubernetes_tools.list_game_servers(**kwargs))
+    except kubernetes_tools.ApiException as e:
+        print_messageId(f'Exception when listing game servers: {e.reason}', level='WARNING')
+        raise BackendError(f'Could not list game servers: {e.reason}')
+
+    state = params.get('state')
+    fields = [field.strip() for field in params.get('fields', '').split(',') if field.strip()]
+    items = []
+    for item in custom_objs['items']:
+        if state and item.get('status', {}).get('state') != state:
+            continue
+        items.append(project(item, fields) if fields else item.get('status'))
+    return {'items': items, 'continue': custom_objs['metadata'].get('continue') or None}
 
-def list_cluster_custom_object_all():
+def list_cluster_custom_object_all(label_selector: str = None):
+    custom_objs = None
     try:
-        custom_objs = kubernetes_tools.custom_obj_client.list_cluster_custom_object(
-            group='agones.dev', 
-            version='v1', 
-            plural='gameservers')
-    except ApiException as e:
-        print_messageId(f'Exception when calling CustomObjectsApi->list_cluster_custom_object: {e}')
+        custom_objs = async_kubernetes_tools.run(async_kubernetes_tools.list_game_servers(label_selector=label_selector))
+    except kubernetes_tools.ApiException as e:
+        print_messageId(f'Exception when listing game servers: {e.reason}', level='WARNING')
     return custom_objs
 
+def percentile(values, p: float):
+    """Nearest-rank percentile of a sorted list."""
+    if len(values) == 0:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+async def create_game_server_allocation(namespace: str, contentBody):
+    started = time.time()
+    try:
+        result = await async_kubernetes_tools.create_game_server_allocation(namespace, contentBody)
+        status = result.get('status', {})
+        # Allocated, UnAllocated when no game server matches, Contention when the allocation lost a race
+        outcome = {'state': status.get('state'), 'status': status}
+    except kubernetes_tools.ApiException as e:
+        print_messageId(f'Exception when creating GameServerAllocation: {e}\n', level='WARNING')   
+        outcome = {'state': 'Error', 'error': e.reason}
+    outcome['latency'] = time.time() - started
+    return outcome
+
+async def create_game_server_allocations(namespace: str, contentBody, num: int, concurrency: int):
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def allocate():
+        async with semaphore:
+            return await create_game_server_allocation(namespace, contentBody)
+
+    return await asyncio.gather(*[allocate() for i in range(num)])
+
 def allocate_game_server(params):
-    num = params.get('num')
+    """Creates num GameServerAllocations, up to concurrency at a time, for the fleet in namespace. selector adds
+    matchLabels as k1=v1,k2=v2. Returns the outcome of every allocation, a count per state and the latency percentiles."""
+    num = int_param(params, 'num', 1)
+    fleet = params.get('fleet', 'minetest')
+    namespace = params.get('namespace', 'default')
+    concurrency = int_param(params, 'concurrency', ALLOCATION_CONCURRENCY)
+
+    matchLabels = {"agones.dev/fleet": fleet}
+    if params.get('selector'):
+        for label in params.get('selector').split(','):
+            key, separator, value = label.partition('=')
+            if separator == '' or key.strip() == '':
+                raise BadRequest(f'selector entries must be key=value, got {label!r}')
+            matchLabels[key.strip()] = value.strip()
 
     contentBody={
         "apiVersion": "allocation.agones.dev/v1",
         "kind": "GameServerAllocation",
         "spec": {
             "required": {
-                "matchLabels":{
-                    "agones.dev/fleet": "minetest"
-                }
+                "matchLabels": matchLabels
             }
         }
     }
 
-    results = []
-    for i in range(int(num)):
-        try:
-            result = kubernetes_tools.custom_obj_client.create_namespaced_custom_object(
-                group='allocation.agones.dev', 
-                version='v1', 
-                namespace="default",
-                plural='gameserverallocations',
-                body=contentBody)
-        except ApiException as e:
-                print_messageId(f'Exception when calling CustomObjectsApi->create_namespaced_custom_object: {e}\n', flush=True)   
-        results.append(result)
-    return results
+    allocations = []
+    if num > 0:
+        allocations = async_kubernetes_tools.run(create_game_server_allocations(namespace, contentBody, num, concurrency))
+
+    summary = {}
+    for allocation in allocations:
+        summary[allocation['state']] = summary.get(allocation['state'], 0) + 1
+    latencies = sorted(allocation['latency'] for allocation in allocations)
+    return {
+        'allocations': allocations,
+        'summary': summary,
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99)
+        }
+    }
+
+def get_metrics(params):
+    """Call counts, errors, throttles and latency percentiles of the external calls of all three services, per
+    service, operation and GameServerGroup, over the current and windows - 1 previous metrics windows (an hour each by
+    default). Filtered by service and group."""
+    return [stat for stat in metrics.aggregates(int(params.get('windows', 1)))
+        if params.get('service') in (None, stat['service']) and params.get('group') in (None, stat['group'])]
 
 def default_handler(params):
     pass
@@ -199,27 +334,141 @@ actiondict = {
     'read_namespaced_pod': read_namespaced_pod,
     'delete_namespaced_pod': delete_namespaced_pod,
     'list_game_server': list_game_server,
-    'allocate_game_server': allocate_game_server
+    'allocate_game_server': allocate_game_server,
+    'get_metrics': get_metrics
 }
 
 def getAction(action, params):
     fun = actiondict.get(action, default_handler)
     return fun(params)
     
+def resource_version(action, params):
+    """The resourceVersions of the collections a Kubernetes read action is built from, read together with lists of
+    one object. None for the other actions, or when the API server could not be asked."""
+    if action == 'list_game_server':
+        probes = [async_kubernetes_tools.list_game_servers(limit=1)]
+    elif action == 'read_namespaced_pod':
+        probes = [async_kubernetes_tools.list_game_servers(limit=1),
+            async_kubernetes_tools.list_pods(label_selector='agones.dev/gameserver', limit=1)]
+    else:
+        return None
+
+    async def probe():
+        return await asyncio.gather(*probes)
+
+    try:
+        lists = async_kubernetes_tools.run(probe())
+    except kubernetes_tools.ApiException as e:
+        print_messageId(f'Exception when reading the resourceVersion: {e.reason}', level='WARNING')
+        return None
+    return '.'.join(result['metadata']['resourceVersion'] for result in lists)
+
+def response_cache_key(params):
+    return 'wrapper.response.' + hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def get_cached_response(params):
+    if r is None:
+        return None
+    try:
+        cached = r.get(response_cache_key(params))
+    except redis.RedisError as e:
+        logger.warning('Could not read response cache', error=str(e))
+        return None
+    if cached is None:
+        return None
+    return json.loads(cached)
+
+def put_cached_response(params, cached):
+    if r is None:
+        return
+    try:
+        r.set(response_cache_key(params), json.dumps(cached), ex=RESPONSE_CACHE_TTL)
+    except redis.RedisError as e:
+        logger.warning('Could not write response cache', error=str(e))
+
+def error_response(statusCode: int, message: str):
+    print_messageId(message, level='WARNING')
+    return {
+        'statusCode': statusCode,
+        'body': json.dumps({'error': message})
+    }
+
+@logger.flushing
+@metrics.emitting
 def lambda_handler(event, context):
+    """Read actions answer with an ETag and a request whose If-None-Match matches gets a 304 without a body.
+    list_game_server and read_namespaced_pod derive the ETag from the parameters and the current resourceVersion of the
+    collections they read, so answering a 304 only costs lists of one object. The resourceVersion moves on with every
+    write the API server sees, so the ETag may change when the response would not, never the other way round. The
+    other read actions use a hash of the response body.
+    Within RESPONSE_CACHE_TTL a response is served from redis without recomputing it, as long as its ETag is current.
+    Cache-Control: no-cache skips the cache. An action whose backend failed is answered with a 502, one that ran out of
+    GameLift or EC2 rate limit with a 429, neither is cached. Malformed parameters get a 400."""
     queryStringParameters = event['queryStringParameters']
     rawQueryString = event['rawQueryString']
     action = queryStringParameters.get('action')
     set_messageId(action,rawQueryString)
+    metrics.set_group(queryStringParameters.get('group'))
 
     if action is None:
         return 
     print_messageId("START!!!!")
-    
-    response = getAction(action, queryStringParameters)
-    
+
+    if action not in cached_actions:
+        try:
+            response = getAction(action, queryStringParameters)
+        except BackendError as e:
+            return error_response(502, str(e))
+        except RateLimited as e:
+            return error_response(429, str(e))
+        except BadRequest as e:
+            return error_response(400, str(e))
+        print_messageId("END!!!!")
+        return {
+            'statusCode': 200,
+            'body': json.dumps(response)
+        }
+
+    # API Gateway HTTP APIs pass header names in lower case
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    etag = None
+    version = resource_version(action, queryStringParameters)
+    if version is not None:
+        etag = '"{}"'.format(hashlib.sha256(f'{response_cache_key(queryStringParameters)}.{version}'.encode()).hexdigest()[:32])
+        if headers.get('if-none-match') == etag:
+            print_messageId("Not modified")
+            return {
+                'statusCode': 304,
+                'headers': {'ETag': etag}
+            }
+    cached = None
+    if headers.get('cache-control') != 'no-cache':
+        cached = get_cached_response(queryStringParameters)
+        # Cached for an older version of the collections
+        if cached is not None and etag is not None and cached['etag'] != etag:
+            cached = None
+    if cached is None:
+        try:
+            body = json.dumps(getAction(action, queryStringParameters))
+        except BackendError as e:
+            return error_response(502, str(e))
+        except RateLimited as e:
+            return error_response(429, str(e))
+        except BadRequest as e:
+            return error_response(400, str(e))
+        cached = {'etag': etag or '"{}"'.format(hashlib.sha256(body.encode()).hexdigest()[:32]), 'body': body}
+        put_cached_response(queryStringParameters, cached)
+    else:
+        print_messageId("Served from response cache")
+
     print_messageId("END!!!!")
+    if headers.get('if-none-match') == cached['etag']:
+        return {
+            'statusCode': 304,
+            'headers': {'ETag': cached['etag']}
+        }
     return {
         'statusCode': 200,
-        'body': json.dumps(response)
+        'headers': {'ETag': cached['etag']},
+        'body': cached['body']
     }